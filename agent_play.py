@@ -0,0 +1,95 @@
+import argparse
+import collections
+import sys
+import threading
+import time
+
+import numpy as np
+
+from asteroids import AsteroidsGame
+from asteroids_core import AsteroidsCore
+
+
+class AgentPilot:
+    # Lets a policy drive a windowed game from a background thread. Every frame the render loop hands over the
+    # newest observation and every tick it applies whichever action was chosen last, so a slow policy call
+    # only delays the agent's reactions, never a frame. Observations the thread did not get to are skipped
+    def __init__(self, game, choose_actions, latency_window=120):
+        self.core = AsteroidsCore(game, metrics_prefix=None)
+        self._game = game
+        self._choose_actions = choose_actions
+        self._condition = threading.Condition()
+        self._observation = None
+        self._observed_at = 0.0
+        self._first = True
+        # Set until the first observation of an episode was handed over, only touched on the render thread
+        self._new_episode = True
+        self._closed = False
+        self.action = None
+        self.latencies = collections.deque(maxlen=latency_window)
+        self._thread = threading.Thread(target=self._run, name='agent-pilot', daemon=True)
+        self._thread.start()
+
+    def observe(self):
+        # Called by the render loop, the game is only ever read on its thread
+        observation = self.core.get_observation().copy()
+        first, self._new_episode = self._new_episode, False
+        with self._condition:
+            self._observation = observation
+            self._first = self._first or first
+            self._observed_at = time.perf_counter()
+            self._condition.notify()
+
+    def act(self):
+        # The game resets on the tick after a collision, the next observation starts a new episode
+        if self._game.game_over:
+            self._new_episode = True
+        action = self.action
+        if action is not None:
+            self.core.apply_action(action)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._observation is not None or self._closed)
+                if self._closed:
+                    return
+                observation, first, observed_at = self._observation, self._first, self._observed_at
+                self._observation = None
+                self._first = False
+            action = self._choose_actions(observation[None], np.array([first]))
+            self.action = int(action[0])
+            self.latencies.append(time.perf_counter() - observed_at)
+
+    def stats_line(self):
+        latencies = list(self.latencies)
+        if not latencies:
+            return "inference -"
+        return f"inference {1000 * np.mean(latencies):.1f} ms (max {1000 * max(latencies):.1f})"
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watch a trained agent play Asteroids')
+    parser.add_argument('--agent', choices=('dqn', 'ppo'), default='dqn')
+    parser.add_argument('--checkpoint-dir', help='training checkpoint, by default the agent script\'s own')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    from inference_server import batched_actions, load_policy
+    choose_actions = batched_actions(load_policy(args.agent, args.checkpoint_dir))
+    game = AsteroidsGame(seed=args.seed)
+    pilot = AgentPilot(game, choose_actions)
+    # The first call compiles the policy, which should not hold up the first frames
+    choose_actions(np.zeros((1,) + pilot.core.observation_shape, dtype=np.float32), np.ones(1, dtype=bool))
+    game.run_game(pilot)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
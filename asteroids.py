@@ -1,35 +1,85 @@
 import time
 
-import pygame
+import array
 import sys
 import math
 import random
+import struct
+
+from headings import COS_TABLE, SIN_TABLE, heading_velocity, rotate_points
+from object_pool import ObjectPool
+from metrics import metrics
+from profiling import profiler
+from timing import tick_timing
+
+# Imported by the first game that opens a window, headless games never load pygame
+pygame = None
+
+
+def load_pygame():
+    global pygame
+    if pygame is None:
+        import pygame as module
+        pygame = module
+    return pygame
 
 
 class AsteroidsGame:
-    def __init__(self):
-        pygame.init()
+    # Packed state layout: a header of player x, y, angle and score, the game and bullet timers, game_over, the
+    # bullet and asteroid counts and the generator's gauss_next, then the Mersenne Twister words as uint32 and
+    # the bullet and asteroid pools as float64
+    STATE_HEADER = struct.Struct('<2d2q2d?2Id')
+    RNG_STATE_SIZE = 625
+
+    def __init__(self, headless=False, seed=None, dt=None):
+        # Headless games only simulate: no window, drawing, fonts or clock
+        self.headless = headless
+        if not self.headless:
+            load_pygame().init()
 
         self.WIDTH, self.HEIGHT = 800, 600
         self.FPS = 60
         self.WHITE = (255, 255, 255)
         self.RED = (255, 0, 0)
 
-        self.screen = pygame.display.set_mode((self.WIDTH, self.HEIGHT), pygame.HWSURFACE | pygame.DOUBLEBUF)
-        pygame.display.set_caption("Asteroids")
-        self.clock = pygame.time.Clock()
+        self.screen = None
+        self.clock = None
+        if not self.headless:
+            # A single software screen: the renderer only repaints what changed, which a double buffer would lose
+            self.screen = pygame.display.set_mode((self.WIDTH, self.HEIGHT))
+            pygame.display.set_caption("Asteroids")
+            self.clock = pygame.time.Clock()
 
+        # Each game draws from its own generator, so a seeded game replays exactly
+        self.random = random.Random(seed)
+
+        # Speeds, turns and timers are per frame at FPS, whatever dt the simulation ticks with
         self.player_size = 50
         self.player_x = self.WIDTH // 2
         self.player_y = self.HEIGHT // 2
         self.player_speed = 5
+        self.turn_speed = 5
         self.player_angle = 0
+        self.player_shape = (
+            (0, -(self.player_size // 1.5)),
+            (self.player_size // 2, self.player_size // 2),
+            (-(self.player_size // 2), self.player_size // 2)
+        )
+        self.player_shapes = {}
 
         self.bullet_speed = 8
-        self.bullets = []
+        self.bullets = ObjectPool(capacity=32)
 
         self.asteroid_speed = 1.3
-        self.asteroids = []
+        self.asteroid_radius = 20
+        self.asteroids = ObjectPool(capacity=64)
+
+        # Side of the uniform grid cells used to find bullet/asteroid pairs, no smaller than a hit distance
+        self.collision_cell_size = 20
+        self.collision_grid_min_pairs = 64
+        # Furthest a bullet may close in on an asteroid between two collision checks. Ticks covering more
+        # are split into substeps, so a coarse dt does not let bullets pass through asteroids
+        self.collision_step = 10
 
         self.game_timer = 0
         self.bullet_timer = 0
@@ -37,6 +87,40 @@ class AsteroidsGame:
         self.player_score = 0
         self.game_over = False
 
+        self.bullet_step = None
+        self.asteroid_step = None
+        self.set_dt(dt)
+
+        # Arrow keys steer the ship unless something else drives it, e.g. an agent in run_game
+        self.keyboard_control = True
+
+        self.renderer = None
+        if not self.headless:
+            from renderer import GameRenderer
+            self.renderer = GameRenderer(self)
+
+        profiler.instrument(self, 'game.', 'move_player', 'move_bullets', 'move_asteroids', 'check_collisions',
+                            'spawn_asteroids', 'draw', 'flip_display')
+
+    def set_dt(self, dt=None):
+        # Simulated seconds per tick, None for one frame at FPS. Objects already in flight keep their headings
+        old_bullet_step, old_asteroid_step = self.bullet_step, self.asteroid_step
+        timing = tick_timing(self, dt)
+        self.dt = timing.dt
+        self.frames_per_tick = timing.frames_per_tick
+        self.substeps = timing.substeps
+        self.player_step = timing.player_step
+        self.turn_step = timing.turn_step
+        self.frame_spawn_chance = 2 / 101
+        self.bullet_step = timing.bullet_step
+        self.asteroid_step = timing.asteroid_step
+        if old_bullet_step is not None:
+            for pool, scale in ((self.bullets, self.bullet_step / old_bullet_step),
+                                (self.asteroids, self.asteroid_step / old_asteroid_step)):
+                for i in range(pool.size):
+                    pool.vx[i] *= scale
+                    pool.vy[i] *= scale
+
     def get_player_x(self):
         return self.player_x
 
@@ -46,78 +130,62 @@ class AsteroidsGame:
     def get_player_angle(self):
         return self.player_angle
 
+    # Read-only copies, the pools themselves are only changed by the game
     def get_asteroids(self):
-        return self.asteroids
+        return self.asteroids.snapshot()
 
     def get_bullets(self):
-        return self.bullets
-
-    def draw_player(self):
-        player_points = [
-            (self.player_x, self.player_y - self.player_size // 1.5),
-            (self.player_x + self.player_size // 2, self.player_y + self.player_size // 2),
-            (self.player_x - self.player_size // 2, self.player_y + self.player_size // 2)
-        ]
-        rotated_points = [
-            (
-                self.player_x + (point[0] - self.player_x) * math.cos(math.radians(self.player_angle)) - (
-                        point[1] - self.player_y) * math.sin(math.radians(self.player_angle)),
-                self.player_y + (point[0] - self.player_x) * math.sin(math.radians(self.player_angle)) + (
-                        point[1] - self.player_y) * math.cos(math.radians(self.player_angle))
-            )
-            for point in player_points
-        ]
-
-        pygame.draw.polygon(self.screen, self.WHITE, rotated_points)
-
-    def draw_bullets(self):
-        for bullet in self.bullets:
-            pygame.draw.circle(self.screen, self.WHITE, (int(bullet[0]), int(bullet[1])), 5)
-
-    def draw_asteroids(self):
-        for asteroid in self.asteroids:
-            pygame.draw.circle(self.screen, self.RED, (int(asteroid[0]), int(asteroid[1])), 20)
+        return self.bullets.snapshot()
+
+    def get_player_points(self):
+        # The ship only turns in whole degrees, so each rotated outline is computed once
+        shape = self.player_shapes.get(self.player_angle)
+        if shape is None:
+            shape = self.player_shapes[self.player_angle] = rotate_points(self.player_shape, self.player_angle)
+        return [(self.player_x + x, self.player_y + y) for x, y in shape]
 
     def move_player(self):
-        keys = pygame.key.get_pressed()
-        if keys[pygame.K_LEFT]:
+        keys = None
+        if not self.headless and self.keyboard_control:
+            keys = pygame.key.get_pressed()
+
+        if keys and keys[pygame.K_LEFT]:
             self.move_player_left()
-        if keys[pygame.K_RIGHT]:
+        if keys and keys[pygame.K_RIGHT]:
             self.move_player_right()
 
         self.player_angle %= 360
 
-        if keys[pygame.K_UP]:
+        if keys and keys[pygame.K_UP]:
             self.move_player_up()
-        if keys[pygame.K_DOWN]:
+        if keys and keys[pygame.K_DOWN]:
             self.move_player_down()
 
         self.player_x = self.player_x % self.WIDTH
         self.player_y = self.player_y % self.HEIGHT
 
-    def move_bullets(self):
-        for i in range(len(self.bullets)):
-            self.bullets[i][0] += self.bullet_speed * math.cos(math.radians(self.bullets[i][2]))
-            self.bullets[i][1] -= self.bullet_speed * math.sin(math.radians(self.bullets[i][2]))
+    def move_objects(self, pool):
+        xs, ys, vxs, vys = pool.x, pool.y, pool.vx, pool.vy
+        # Walk backwards so a swap-removed slot is refilled by an object that has already moved
+        for i in range(pool.size - 1, -1, -1):
+            x = xs[i] + vxs[i]
+            y = ys[i] + vys[i]
+            if x < 0 or x > self.WIDTH or y < 0 or y > self.HEIGHT:
+                pool.remove(i)
+            else:
+                xs[i] = x
+                ys[i] = y
 
-            if self.bullets[i][0] < 0 or self.bullets[i][0] > self.WIDTH or self.bullets[i][1] < 0 or self.bullets[i][
-                1] > self.HEIGHT:
-                self.bullets.pop(i)
-                break
+    def move_bullets(self):
+        self.move_objects(self.bullets)
 
     def move_asteroids(self):
-        for i in range(len(self.asteroids)):
-            self.asteroids[i][0] += self.asteroid_speed * math.cos(math.radians(self.asteroids[i][2]))
-            self.asteroids[i][1] -= self.asteroid_speed * math.sin(math.radians(self.asteroids[i][2]))
-
-            if self.asteroids[i][0] < 0 or self.asteroids[i][0] > self.WIDTH or self.asteroids[i][1] < 0 or \
-                    self.asteroids[i][1] > self.HEIGHT:
-                self.asteroids.pop(i)
-                break
+        self.move_objects(self.asteroids)
 
     def reset(self):
-        print("Game Over!")
-        print(f"Your score: {self.player_score}")
+        if self.game_over:
+            metrics.record('game/score', self.player_score)
+            metrics.record('game/ticks', self.game_timer)
         self.game_over = False
         self.player_x = self.WIDTH // 2
         self.player_y = self.HEIGHT // 2
@@ -130,42 +198,130 @@ class AsteroidsGame:
     def render(self):
         self.update()
 
-        pygame.display.flip()
-        self.clock.tick()
+        if not self.headless:
+            self.flip_display()
+
+    def flip_display(self):
+        self.renderer.flip()
 
     def check_collisions(self):
-        for asteroid in self.asteroids:
-            distance = math.sqrt((self.player_x - asteroid[0]) ** 2 + (self.player_y - asteroid[1]) ** 2)
-            if distance < self.player_size / 2 + 20:
+        if not self.asteroids:
+            return
+
+        asteroids_x = self.asteroids.x
+        asteroids_y = self.asteroids.y
+        player_distance = (self.player_size / 2 + self.asteroid_radius) ** 2
+        for i in range(self.asteroids.size):
+            dx = self.player_x - asteroids_x[i]
+            dy = self.player_y - asteroids_y[i]
+            if dx * dx + dy * dy < player_distance:
                 self.game_over = True
+                break
 
-        for bullet in self.bullets:
-            for asteroid in self.asteroids:
-                distance = math.sqrt((bullet[0] - asteroid[0]) ** 2 + (bullet[1] - asteroid[1]) ** 2)
-                if distance < 20:
-                    self.bullets.remove(bullet)
-                    self.asteroids.remove(asteroid)
-                    self.player_score += 1
-                    break
+        if not self.bullets:
+            return
+
+        # Building the grid only pays off once there are enough pairs to skip
+        use_grid = self.bullets.size * self.asteroids.size > self.collision_grid_min_pairs
+        if use_grid:
+            grid = self.build_asteroid_grid()
+        all_asteroids = range(self.asteroids.size)
+        hit_distance = self.asteroid_radius ** 2
+        hit_asteroids = set()
+        hit_bullets = []
+
+        bullets_x = self.bullets.x
+        bullets_y = self.bullets.y
+        for bullet_index in range(self.bullets.size):
+            bullet_x = bullets_x[bullet_index]
+            bullet_y = bullets_y[bullet_index]
+            nearby = self.nearby_asteroids(grid, bullet_x, bullet_y) if use_grid else all_asteroids
+            # A bullet takes the first remaining asteroid in pool order
+            target = None
+            for asteroid_index in nearby:
+                if asteroid_index in hit_asteroids or (target is not None and asteroid_index > target):
+                    continue
+                dx = bullet_x - asteroids_x[asteroid_index]
+                dy = bullet_y - asteroids_y[asteroid_index]
+                if dx * dx + dy * dy < hit_distance:
+                    target = asteroid_index
+
+            if target is not None:
+                hit_asteroids.add(target)
+                hit_bullets.append(bullet_index)
+                self.player_score += 1
+
+        if hit_bullets:
+            self.bullets.remove_many(hit_bullets)
+            self.asteroids.remove_many(hit_asteroids)
+
+    def build_asteroid_grid(self):
+        cell_size = self.collision_cell_size
+        grid = {}
+        for index in range(self.asteroids.size):
+            key = (int(self.asteroids.x[index] // cell_size), int(self.asteroids.y[index] // cell_size))
+            grid.setdefault(key, []).append(index)
+        return grid
+
+    def nearby_asteroids(self, grid, x, y):
+        cell_x = int(x // self.collision_cell_size)
+        cell_y = int(y // self.collision_cell_size)
+        nearby = []
+        for grid_x in (cell_x - 1, cell_x, cell_x + 1):
+            for grid_y in (cell_y - 1, cell_y, cell_y + 1):
+                nearby.extend(grid.get((grid_x, grid_y), ()))
+        return nearby
 
     def move_player_left(self):
-        self.player_angle -= 5
+        self.player_angle -= self.turn_step
 
     def move_player_right(self):
-        self.player_angle += 5
+        self.player_angle += self.turn_step
 
     def move_player_up(self):
-        self.player_x += self.player_speed * math.sin(math.radians(self.player_angle))
-        self.player_y -= self.player_speed * math.cos(math.radians(self.player_angle))
+        degree = self.player_angle % 360
+        self.player_x += self.player_step * SIN_TABLE[degree]
+        self.player_y -= self.player_step * COS_TABLE[degree]
 
     def move_player_down(self):
-        self.player_x -= self.player_speed * math.sin(math.radians(self.player_angle))
-        self.player_y += self.player_speed * math.cos(math.radians(self.player_angle))
+        degree = self.player_angle % 360
+        self.player_x -= self.player_step * SIN_TABLE[degree]
+        self.player_y += self.player_step * COS_TABLE[degree]
 
     def shoot_bullet(self):
-        self.bullets.append([self.player_x, self.player_y, 90 - self.player_angle])
+        heading = 90 - self.player_angle
+        self.bullets.append(self.player_x, self.player_y, heading, *heading_velocity(heading, self.bullet_step))
         self.bullet_timer = 0
 
+    def get_state(self):
+        _, rng_state, gauss_next = self.random.getstate()
+        header = self.STATE_HEADER.pack(self.player_x, self.player_y, self.player_angle, self.player_score,
+                                        self.game_timer, self.bullet_timer, self.game_over, self.bullets.size,
+                                        self.asteroids.size, math.nan if gauss_next is None else gauss_next)
+        pools = array.array('d', self.bullets.get_state() + self.asteroids.get_state())
+        return header + array.array('I', rng_state).tobytes() + pools.tobytes()
+
+    def set_state(self, state):
+        (self.player_x, self.player_y, player_angle, player_score, game_timer, bullet_timer, game_over,
+         num_bullets, num_asteroids, gauss_next) = self.STATE_HEADER.unpack_from(state)
+        self.player_angle = player_angle
+        self.player_score = player_score
+        # Timers count frames, which are only whole with a whole number of frames per tick
+        timer_type = int if isinstance(self.frames_per_tick, int) else float
+        self.game_timer = timer_type(game_timer)
+        self.bullet_timer = timer_type(bullet_timer)
+        self.game_over = game_over
+
+        rng_start = self.STATE_HEADER.size
+        rng_end = rng_start + 4 * self.RNG_STATE_SIZE
+        self.random.setstate((3, tuple(array.array('I', bytes(state[rng_start:rng_end]))),
+                              None if math.isnan(gauss_next) else gauss_next))
+
+        pools = array.array('d', bytes(state[rng_end:])).tolist()
+        bullets_end = 5 * num_bullets
+        self.bullets.set_state(pools[:bullets_end], num_bullets)
+        self.asteroids.set_state(pools[bullets_end:bullets_end + 5 * num_asteroids], num_asteroids)
+
     def get_collided(self):
         return self.game_over
 
@@ -173,53 +329,101 @@ class AsteroidsGame:
         return self.player_score
 
     def spawn_asteroids(self):
-        pos_x = random.randint(0, self.WIDTH)
-        pos_y = random.randint(0, self.HEIGHT)
+        pos_x = self.random.randint(0, self.WIDTH)
+        pos_y = self.random.randint(0, self.HEIGHT)
         if pos_x not in (self.player_x - 50, self.player_x + 50):
             if pos_y not in (self.player_y - 50, self.player_y + 50):
-                (self.asteroids
-                 .append([random.randint(0, self.WIDTH), random.randint(0, self.HEIGHT), random.randint(0, 360)]))
-
-    def update(self):
+                x = self.random.randint(0, self.WIDTH)
+                y = self.random.randint(0, self.HEIGHT)
+                heading = self.random.randint(0, 360)
+                self.asteroids.append(x, y, heading, *heading_velocity(heading, self.asteroid_step))
+
+    def spawn_count(self):
+        # Every frame of the tick spawns an asteroid with a chance of 2 in 101, a fractional last frame with its
+        # share of that chance. One frame per tick keeps the original draw, so seeded default games play out as before
+        if self.frames_per_tick == 1:
+            return int(self.random.randint(0, 100) < 2)
+        frames = math.floor(self.frames_per_tick)
+        count = sum(self.random.random() < self.frame_spawn_chance for _ in range(frames))
+        partial = self.frames_per_tick - frames
+        if partial and self.random.random() < partial * self.frame_spawn_chance:
+            count += 1
+        return count
+
+    def step(self):
         if not self.game_over:
             self.move_player()
-            self.move_bullets()
-            self.move_asteroids()
-            self.check_collisions()
-
-            self.screen.fill((0, 0, 0))
-            self.draw_player()
-            self.draw_bullets()
-            self.draw_asteroids()
+            for _ in range(self.substeps):
+                self.move_bullets()
+                self.move_asteroids()
+                self.check_collisions()
+                if self.game_over:
+                    break
 
-            if random.randint(0, 100) < 2:
+            for _ in range(self.spawn_count()):
                 self.spawn_asteroids()
-
-            font = pygame.font.Font(None, 36)
-            text = font.render("Score: " + str(self.player_score), True, self.WHITE)
-            self.screen.blit(text, (10, 10))
         else:
             self.reset()
-        self.bullet_timer += 1
-        self.game_timer += 1
+        self.bullet_timer += self.frames_per_tick
+        self.game_timer += self.frames_per_tick
 
-    def run_game(self):
+    def draw(self):
+        self.renderer.draw()
+
+    def update(self):
+        self.step()
+
+        if not self.headless:
+            self.draw()
+
+    def run_game(self, pilot=None, show_stats=None):
+        # Fixed timestep: the simulation advances in ticks of dt however fast frames are drawn, and a
+        # slow frame is caught up with extra ticks, up to a quarter second at once.
+        # A pilot, e.g. agent_play.AgentPilot, drives the ship instead of the keyboard. show_stats overlays
+        # frame times and the pilot's inference latency, by default whenever a pilot drives
+        self.keyboard_control = pilot is None
+        show_stats = pilot is not None if show_stats is None else show_stats
+        frame_times = []
+        stats_time = time.perf_counter()
+        accumulator = 0.0
+        previous = time.perf_counter()
         while True:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
+                    if pilot is not None:
+                        pilot.close()
                     pygame.quit()
                     sys.exit()
                 elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_SPACE and self.timer >= 5:
+                    if event.key == pygame.K_SPACE and self.keyboard_control and self.bullet_timer >= 5:
                         self.shoot_bullet()
-
-            self.update()
-
-            font = pygame.font.Font(None, 36)
-            text = font.render("Score: " + str(self.player_score), True, self.WHITE)
-            self.screen.blit(text, (10, 10))
-
-            pygame.display.flip()
+                elif event.type == pygame.WINDOWEXPOSED:
+                    self.renderer.invalidate()
+
+            now = time.perf_counter()
+            frame_times.append(now - previous)
+            accumulator = min(accumulator + now - previous, 0.25)
+            previous = now
+            while accumulator >= self.dt:
+                if pilot is not None:
+                    pilot.act()
+                self.step()
+                accumulator -= self.dt
+            if pilot is not None:
+                pilot.observe()
+
+            # The overlay text changes a few times a second, not every frame
+            if show_stats and now - stats_time >= 0.25:
+                lines = [f"frame {1000 * sum(frame_times) / len(frame_times):.1f} ms "
+                         f"(max {1000 * max(frame_times):.1f})"]
+                if pilot is not None:
+                    lines.append(pilot.stats_line())
+                self.renderer.set_overlay(lines)
+                frame_times = []
+                stats_time = now
+
+            self.draw()
+            self.renderer.flip()
             self.clock.tick(self.FPS)
 
 
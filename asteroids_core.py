@@ -0,0 +1,344 @@
+import heapq
+
+import numpy as np
+
+from batched_asteroids import BatchedAsteroidsGame
+from metrics import metrics
+from profiling import profiler
+
+
+def core_spec(core):
+    # Everything the tf_agents specs need, plain enough to send from a worker process
+    return core.observation_shape, core.observation_dtype, core.observation_bounds, core.num_actions
+
+
+class AsteroidsCore:
+    num_actions = 5
+    vectorize_threshold = 32
+
+    def __init__(self, asteroids_game, num_nearest=1, include_velocities=False, wrap_distances=False,
+                 pixel_observations=False, frame_size=(84, 84), frame_stack=4, frame_skip=1,
+                 max_pool_frames=False, seed=None, metrics_prefix='episode/'):
+        self._random = np.random.default_rng(seed)
+        # Each step repeats the action for frame_skip game ticks and observes only the last one
+        self._frame_skip = frame_skip
+        self._max_pool_frames = max_pool_frames
+        # Player x, y and angle, then the k nearest asteroids and the k nearest bullets as
+        # dx, dy offsets (plus vx, vy when velocities are included), nearest first. Velocities are in pixels per
+        # 1/60 s frame like the game's speeds, whatever dt and substeps the game ticks with
+        self._num_nearest = num_nearest
+        self._include_velocities = include_velocities
+        self._wrap_distances = wrap_distances
+        self._object_size = 4 if include_velocities else 2
+        self.observation_shape = (3 + 2 * num_nearest * self._object_size,)
+        self.observation_dtype = np.dtype(np.float32)
+        self.observation_bounds = None
+        self._asteroids_game = asteroids_game
+
+        # Pixel mode replaces the vector with a stack of small grayscale frames
+        self._pixel_observer = None
+        if pixel_observations:
+            from pixel_observation import PixelObserver
+            self._pixel_observer = PixelObserver(asteroids_game, frame_size, frame_stack)
+            self.observation_shape = self._pixel_observer.observation_shape()
+            self.observation_dtype = np.dtype(np.uint8)
+            self.observation_bounds = (0, 255)
+
+        self._reward = 0.0
+        self._score = 0
+        self._last_score = 0
+        self._distance = 0
+        self._episode_ended = False
+        # Finished episodes are recorded under metrics_prefix, None records nothing
+        self._metrics_prefix = metrics_prefix
+        self._episode_return = 0.0
+        self._episode_length = 0
+        self._observation = np.full(self.observation_shape, 0, dtype=np.float32)
+        self._dx = np.zeros(0, dtype=np.float64)
+        self._dy = np.zeros(0, dtype=np.float64)
+        self._distances = np.zeros(0, dtype=np.float64)
+
+        profiler.instrument(self, 'env.', 'get_observation')
+
+    def seed(self, seed):
+        self._asteroids_game.random.seed(seed)
+        self._random = np.random.default_rng(seed)
+
+    def reset(self):
+        self._episode_ended = False
+        self._asteroids_game.reset()
+        if self._pixel_observer:
+            self._observation = self._pixel_observer.reset()
+        else:
+            self._observation.fill(0)
+        self._reward = 0.0
+        self._last_score = 0
+        self._episode_return = 0.0
+        self._episode_length = 0
+        return self._observation
+
+    def random_action(self):
+        return self._random.integers(0, 2)
+
+    def apply_action(self, action):
+        if action == 0:
+            self._asteroids_game.move_player_left()
+        elif action == 1:
+            self._asteroids_game.move_player_right()
+        elif action == 2:
+            self._asteroids_game.move_player_up()
+        elif action == 3:
+            self._asteroids_game.move_player_down()
+        elif action == 4:
+            if self._asteroids_game.bullet_timer >= 5:
+                self._asteroids_game.shoot_bullet()
+
+    def tick_reward(self):
+        self._score = self._asteroids_game.get_score()
+
+        time_reward = self._asteroids_game.game_timer / 1000.0
+        score_time_ratio = self._score / (time_reward * 100)
+        reward = time_reward + score_time_ratio
+
+        if self._score > self._last_score:
+            reward = self._score + time_reward + score_time_ratio
+            self._last_score = self._score
+
+        return reward
+
+    def step(self, action):
+        # Returns (observation, reward, done); the episode has to be reset once done
+        # In pixel mode the observation can be the max of the last two ticks, so objects that
+        # only show up on one of them do not flicker out of the frame
+        pool_frames = self._pixel_observer is not None and self._max_pool_frames and self._frame_skip > 1
+        held_frame = False
+        total_reward = 0.0
+        for tick in range(self._frame_skip):
+            self.apply_action(action)
+            self._asteroids_game.render()
+
+            if self._asteroids_game.get_collided():
+                break
+            self._reward = self.tick_reward()
+            total_reward += self._reward
+
+            if pool_frames and tick == self._frame_skip - 2:
+                self._pixel_observer.hold_frame()
+                held_frame = True
+
+        if held_frame:
+            observation = self._pixel_observer.observe(max_with_held=True)
+        else:
+            observation = self.get_observation()
+        self.set_observation(observation)
+
+        self._episode_length += 1
+        if self._asteroids_game.get_collided():
+            self._episode_ended = True
+            self._episode_return += total_reward - 10
+            self.record_episode()
+            return observation, total_reward - 10, True
+
+        self._episode_return += total_reward
+        return observation, total_reward, False
+
+    def record_episode(self):
+        prefix = self._metrics_prefix
+        if prefix is not None:
+            metrics.record(prefix + 'return', self._episode_return)
+            metrics.record(prefix + 'length', self._episode_length)
+            metrics.record(prefix + 'score', self._score)
+
+    def set_observation(self, observation):
+        self._observation = observation
+
+    def nearest_objects(self, pool, out):
+        # Fills out with the offsets (and velocities) of the nearest objects in pool, nearest first
+        out.fill(0)
+        size = pool.size
+        if not size:
+            return
+        objects = out.reshape(-1, self._object_size)
+        count = min(len(objects), size)
+
+        # NumPy call overhead outweighs a plain loop for the handful of objects of a normal game
+        if size <= self.vectorize_threshold:
+            nearest = self._nearest_small(pool, count)
+            for row, (dx, dy, index) in enumerate(nearest):
+                objects[row, 0] = dx
+                objects[row, 1] = dy
+            indices = [index for _, _, index in nearest]
+        else:
+            dx, dy, indices = self._nearest_vectorized(pool, count)
+            objects[:count, 0] = dx
+            objects[:count, 1] = dy
+
+        if self._include_velocities:
+            # The pools hold displacements per substep
+            game = self._asteroids_game
+            scale = game.substeps / game.frames_per_tick
+            objects[:count, 2] = [pool.vx[i] * scale for i in indices]
+            objects[:count, 3] = [pool.vy[i] * scale for i in indices]
+
+    def _nearest_small(self, pool, count):
+        player_x = self._asteroids_game.get_player_x()
+        player_y = self._asteroids_game.get_player_y()
+        width = self._asteroids_game.WIDTH
+        height = self._asteroids_game.HEIGHT
+        candidates = []
+        for i in range(pool.size):
+            dx = pool.x[i] - player_x
+            dy = pool.y[i] - player_y
+            if self._wrap_distances:
+                dx -= width * round(dx / width)
+                dy -= height * round(dy / height)
+            candidates.append((dx * dx + dy * dy, dx, dy, i))
+        nearest = [min(candidates)] if count == 1 else heapq.nsmallest(count, candidates)
+        return [(dx, dy, i) for _, dx, dy, i in nearest]
+
+    def _nearest_vectorized(self, pool, count):
+        size = pool.size
+        if len(self._dx) < size:
+            capacity = max(size, 2 * len(self._dx))
+            self._dx = np.zeros(capacity, dtype=np.float64)
+            self._dy = np.zeros(capacity, dtype=np.float64)
+            self._distances = np.zeros(capacity, dtype=np.float64)
+
+        dx = self._dx[:size]
+        dy = self._dy[:size]
+        distances = self._distances[:size]
+        dx[:] = pool.x[:size]
+        dy[:] = pool.y[:size]
+        dx -= self._asteroids_game.get_player_x()
+        dy -= self._asteroids_game.get_player_y()
+
+        if self._wrap_distances:
+            # The player wraps around the screen, so an object near the far edge is also close
+            for offsets, extent in ((dx, self._asteroids_game.WIDTH), (dy, self._asteroids_game.HEIGHT)):
+                np.divide(offsets, extent, out=distances)
+                np.rint(distances, out=distances)
+                distances *= extent
+                offsets -= distances
+
+        np.multiply(dx, dx, out=distances)
+        distances += dy * dy
+
+        if count < size:
+            nearest = np.argpartition(distances, count - 1)[:count]
+            nearest = nearest[np.argsort(distances[nearest])]
+        else:
+            nearest = np.argsort(distances)
+        return dx[nearest], dy[nearest], nearest.tolist()
+
+    def calculate_closest_asteroid(self):
+        closest = np.zeros(self._object_size, dtype=np.float32)
+        self.nearest_objects(self._asteroids_game.asteroids, closest)
+        return closest[0], closest[1]
+
+    def calculate_closest_bullet(self):
+        closest = np.zeros(self._object_size, dtype=np.float32)
+        self.nearest_objects(self._asteroids_game.bullets, closest)
+        return closest[0], closest[1]
+
+    def get_observation(self):
+        if self._pixel_observer:
+            return self._pixel_observer.observe()
+
+        # Written in place into the preallocated buffer, so it is only valid until the next step
+        observation = self._observation
+        observation[0] = self._asteroids_game.get_player_x()
+        observation[1] = self._asteroids_game.get_player_y()
+        observation[2] = self._asteroids_game.get_player_angle()
+
+        objects_size = self._num_nearest * self._object_size
+        self.nearest_objects(self._asteroids_game.asteroids, observation[3:3 + objects_size])
+        self.nearest_objects(self._asteroids_game.bullets, observation[3 + objects_size:])
+
+        return observation
+
+    def get_score(self):
+        return self._score
+
+    def get_distance(self):
+        return self._distance
+
+    def get_reward(self):
+        return self._reward
+
+    def get_episode_ended(self):
+        return self._episode_ended
+
+
+class BatchedAsteroidsCore:
+    num_actions = 5
+
+    def __init__(self, batch_size, seed=None, frame_skip=1, metrics_prefix='episode/', dt=None):
+        self.observation_shape = (7,)
+        self.observation_dtype = np.dtype(np.float32)
+        self.observation_bounds = None
+        self.batch_size = batch_size
+        self._frame_skip = frame_skip
+        self._asteroids_game = BatchedAsteroidsGame(batch_size, seed=seed, dt=dt)
+        self._last_score = np.zeros(batch_size, dtype=np.int64)
+        self._episode_ended = np.zeros(batch_size, dtype=bool)
+        self._metrics_prefix = metrics_prefix
+        self._episode_return = np.zeros(batch_size, dtype=np.float64)
+        self._episode_length = np.zeros(batch_size, dtype=np.int64)
+        self._observation = np.zeros((batch_size,) + self.observation_shape, dtype=np.float32)
+
+    def reset(self):
+        self._asteroids_game.reset()
+        self._episode_ended[:] = False
+        self._last_score[:] = 0
+        self._episode_return[:] = 0
+        self._episode_length[:] = 0
+        self._asteroids_game.get_observations(out=self._observation)
+        return self._observation
+
+    def tick_rewards(self):
+        game = self._asteroids_game
+        score = game.player_score
+        time_reward = game.game_timer / 1000.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score_time_ratio = score / (time_reward * 100)
+        reward = time_reward + score_time_ratio
+        scored = score > self._last_score
+        reward[scored] += score[scored]
+        self._last_score[scored] = score[scored]
+        return reward
+
+    def step(self, action):
+        # Returns (observation, reward, restarted, collided) with one entry per world
+        game = self._asteroids_game
+
+        # Worlds that ended on the previous step restart instead of consuming their action
+        restarted = self._episode_ended.copy()
+        if restarted.any():
+            game.reset(restarted)
+            self._last_score[restarted] = 0
+            self._episode_return[restarted] = 0
+            self._episode_length[restarted] = 0
+
+        # Every world repeats its action for frame_skip ticks or until it collides
+        active = ~restarted
+        reward = np.zeros(self.batch_size, dtype=np.float64)
+        for _ in range(self._frame_skip):
+            game.step(action, active)
+            active &= ~game.game_over
+            reward += np.where(active, self.tick_rewards(), 0.0)
+        game.get_observations(out=self._observation)
+
+        collided = game.game_over & ~restarted
+        reward[collided] -= 10
+        reward[restarted] = 0
+
+        self._episode_return += reward
+        self._episode_length += ~restarted
+        if collided.any() and self._metrics_prefix is not None:
+            prefix = self._metrics_prefix
+            metrics.record_many(prefix + 'return', self._episode_return[collided])
+            metrics.record_many(prefix + 'length', self._episode_length[collided])
+            metrics.record_many(prefix + 'score', game.player_score[collided])
+
+        self._episode_ended = collided
+        return self._observation, reward, restarted, collided
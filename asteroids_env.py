@@ -1,30 +1,38 @@
-import math
-import time
-
 import numpy as np
 from tf_agents.environments import tf_py_environment
 from tf_agents.trajectories import time_step as ts
 from tf_agents.specs import array_spec
-from gym import spaces
+
+from asteroids_core import AsteroidsCore, BatchedAsteroidsCore, core_spec
+from profiling import profiler
+
+
+def create_specs(observation_shape, observation_dtype, observation_bounds, num_actions):
+    action_spec = array_spec.BoundedArraySpec(
+        shape=(), dtype=np.int32, minimum=0, maximum=num_actions, name='action')
+    if observation_bounds is None:
+        observation_spec = array_spec.ArraySpec(shape=observation_shape, dtype=observation_dtype, name='observation')
+    else:
+        minimum, maximum = observation_bounds
+        observation_spec = array_spec.BoundedArraySpec(
+            shape=observation_shape, dtype=observation_dtype, minimum=minimum, maximum=maximum, name='observation')
+    return observation_spec, action_spec
 
 
 class AsteroidsEnvironment(tf_py_environment.py_environment.PyEnvironment):
-    def __init__(self, asteroids_game):
+    # A tf_agents view of an AsteroidsCore, which holds the simulation, observations and rewards.
+    # recorder is an optional EpisodeRecorder from episode_recording that archives every episode played
+    def __init__(self, asteroids_game, recorder=None, **core_options):
         super().__init__()
-        self._observation_shape = (7,)
-        self._asteroids_game = asteroids_game
-        self._action_spec = array_spec.BoundedArraySpec(
-            shape=(), dtype=np.int32, minimum=0, maximum=5, name='action')
-        self._observation_spec = array_spec.ArraySpec(
-            shape=self._observation_shape, dtype=np.float32, name='observation')
-        self.action_space = spaces.Discrete(5)
-        self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=self._observation_shape, dtype=np.float32)
-        self._reward = 0.0
-        self._score = 0
-        self._last_score = 0
-        self._distance = 0
-        self._episode_ended = False
-        self._observation = np.full(self._observation_shape, 0, dtype=np.float32)
+        self.core = AsteroidsCore(asteroids_game, **core_options)
+        self._observation_spec, self._action_spec = create_specs(*core_spec(self.core))
+        self._action_space = None
+        self._observation_space = None
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.attach(asteroids_game, core_options.get('frame_skip', 1))
+
+        profiler.instrument(self, 'env.', '_step')
 
     def action_spec(self):
         return self._action_spec
@@ -32,127 +40,119 @@ class AsteroidsEnvironment(tf_py_environment.py_environment.PyEnvironment):
     def observation_spec(self):
         return self._observation_spec
 
-    def _reset(self):
-        self._episode_ended = False
-        self._asteroids_game.reset()
-        self._observation = np.full(self._observation_shape, 0, dtype=np.float32)
-        self._reward = 0.0
-        self._last_score = 0
-        return ts.restart(np.squeeze(self._observation))
-
-    def random_action(self):
-        self.random_action = np.random.Generator(np.random.MT19937()).integers(0, 2)
-        return self.random_action
+    # gym is only imported once the spaces are read, so the environment still loads without it
 
-    def _step(self, action):
-        if self._episode_ended:
-            return self.reset()
+    @property
+    def action_space(self):
+        if self._action_space is None:
+            from gym import spaces
+            self._action_space = spaces.Discrete(self.core.num_actions)
+        return self._action_space
 
-        if action == 0:
-            self._asteroids_game.move_player_left()
-        elif action == 1:
-            self._asteroids_game.move_player_right()
-        elif action == 2:
-            self._asteroids_game.move_player_up()
-        elif action == 3:
-            self._asteroids_game.move_player_down()
-        elif action == 4:
-            if self._asteroids_game.bullet_timer >= 5:
-                self._asteroids_game.shoot_bullet()
+    @property
+    def observation_space(self):
+        if self._observation_space is None:
+            from gym import spaces
+            low, high = self.core.observation_bounds or (-np.inf, np.inf)
+            self._observation_space = spaces.Box(low=low, high=high, shape=self.core.observation_shape,
+                                                 dtype=self.core.observation_dtype)
+        return self._observation_space
 
-        self._asteroids_game.render()
+    def _reset(self):
+        # The core reuses its observation buffer, every TimeStep handed out gets its own copy
+        observation = self.core.reset().copy()
+        if self.recorder is not None:
+            self.recorder.begin_episode()
+        return ts.restart(observation)
 
-        observation = self.get_observation()
-        self.set_observation(observation)
+    def _step(self, action):
+        if self.core.get_episode_ended():
+            return self.reset()
 
-        self._score = self._asteroids_game.get_score()
+        if self.recorder is not None:
+            self.recorder.record(action)
+        observation, reward, done = self.core.step(action)
+        observation = observation.copy()
+        if done:
+            return ts.termination(observation=observation, reward=reward)
+        return ts.transition(observation=observation, reward=np.squeeze(reward), discount=1.0)
 
-        time_reward = self._asteroids_game.game_timer / 1000.0
-        score_time_ratio = self._score / (time_reward * 100)
-        self._reward = time_reward + score_time_ratio
+    # The game logic moved into the core, these forward the helpers the environment had before
 
-        if self._score > self._last_score:
-            self._reward = self._score + time_reward + score_time_ratio
-            self._last_score = self._score
+    def random_action(self):
+        return self.core.random_action()
 
-        if self._asteroids_game.get_collided():
-            self._episode_ended = True
-            print(f"Episode ended, last_reward: {self._reward}, score: {self._score}")
-            return ts.termination(observation=np.squeeze(observation), reward=-10)
+    def apply_action(self, action):
+        self.core.apply_action(action)
 
-        return ts.transition(observation=np.squeeze(observation), reward=np.squeeze(self._reward), discount=1.0)
+    def tick_reward(self):
+        return self.core.tick_reward()
 
     def set_observation(self, observation):
-        self._observation = observation
+        self.core.set_observation(observation)
+
+    def nearest_objects(self, pool, out):
+        self.core.nearest_objects(pool, out)
 
     def calculate_closest_asteroid(self):
-        player_x = self._asteroids_game.get_player_x()
-        player_y = self._asteroids_game.get_player_y()
-        closest_asteroid_dx = float('inf')
-        closest_asteroid_dy = float('inf')
-
-        for asteroid in self._asteroids_game.get_asteroids():
-            dx = asteroid[0] - player_x
-            dy = asteroid[1] - player_y
-            distance = dx ** 2 + dy ** 2
-            if distance < closest_asteroid_dx ** 2 + closest_asteroid_dy ** 2:
-                closest_asteroid_dx = dx
-                closest_asteroid_dy = dy
-
-        # Return the distances if asteroids exist, else return zeros
-        if closest_asteroid_dx == float('inf') and closest_asteroid_dy == float('inf'):
-            return 0, 0
-        else:
-            return closest_asteroid_dx, closest_asteroid_dy
+        return self.core.calculate_closest_asteroid()
 
     def calculate_closest_bullet(self):
-        player_x = self._asteroids_game.get_player_x()
-        player_y = self._asteroids_game.get_player_y()
-        closest_bullet_dx = float('inf')
-        closest_bullet_dy = float('inf')
-
-        for bullet in self._asteroids_game.get_bullets():
-            dx = bullet[0] - player_x
-            dy = bullet[1] - player_y
-            distance = dx ** 2 + dy ** 2
-            if distance < closest_bullet_dx ** 2 + closest_bullet_dy ** 2:
-                closest_bullet_dx = dx
-                closest_bullet_dy = dy
-
-        # Return the distances if bullets exist, else return zeros
-        if closest_bullet_dx == float('inf') and closest_bullet_dy == float('inf'):
-            return 0, 0
-        else:
-            return closest_bullet_dx, closest_bullet_dy
+        return self.core.calculate_closest_bullet()
 
     def get_observation(self):
-        player_x = self._asteroids_game.get_player_x()
-        player_y = self._asteroids_game.get_player_y()
-        player_angle = self._asteroids_game.get_player_angle()
-
-        closest_asteroid_dx, closest_asteroid_dy = self.calculate_closest_asteroid()
-        closest_bullet_dx, closest_bullet_dy = self.calculate_closest_bullet()
-
-        observation = np.array([
-            player_x,
-            player_y,
-            player_angle,
-            closest_asteroid_dx,
-            closest_asteroid_dy,
-            closest_bullet_dx,
-            closest_bullet_dy
-        ], dtype=np.float32)
-
-        return observation
+        return self.core.get_observation()
 
     def get_score(self):
-        return self._score
+        return self.core.get_score()
 
     def get_distance(self):
-        return self._distance
+        return self.core.get_distance()
 
     def get_reward(self):
-        return self._reward
+        return self.core.get_reward()
 
     def get_episode_ended(self):
-        return self._episode_ended
+        return self.core.get_episode_ended()
+
+
+class BatchedAsteroidsEnvironment(tf_py_environment.py_environment.PyEnvironment):
+    def __init__(self, batch_size, seed=None, frame_skip=1, metrics_prefix='episode/', dt=None):
+        super().__init__()
+        self.core = BatchedAsteroidsCore(batch_size, seed=seed, frame_skip=frame_skip, metrics_prefix=metrics_prefix,
+                                         dt=dt)
+        self._batch_size = batch_size
+        self._observation_spec, self._action_spec = create_specs(*core_spec(self.core))
+
+        profiler.instrument(self, 'batched_env.', '_step')
+
+    @property
+    def batched(self):
+        return True
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def action_spec(self):
+        return self._action_spec
+
+    def observation_spec(self):
+        return self._observation_spec
+
+    def _reset(self):
+        return ts.restart(self.core.reset().copy(), batch_size=self._batch_size)
+
+    def _step(self, action):
+        observation, reward, restarted, collided = self.core.step(action)
+
+        step_type = np.full(self._batch_size, ts.StepType.MID, dtype=np.int32)
+        step_type[collided] = ts.StepType.LAST
+        step_type[restarted] = ts.StepType.FIRST
+        discount = np.where(collided, 0.0, 1.0).astype(np.float32)
+
+        return ts.TimeStep(step_type, reward.astype(np.float32), discount, observation.copy())
+
+    def tick_rewards(self):
+        # Forwarded to the core, which holds the game logic now
+        return self.core.tick_rewards()
@@ -0,0 +1,88 @@
+import multiprocessing
+import queue
+import signal
+
+
+def _worker(requests, results, policy_constructor, num_episodes, frame_skip, dt, max_steps):
+    # Ctrl+C is handled by the training script, which stops the evaluator through close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from tf_agents.environments import tf_py_environment
+
+    from asteroids_env import BatchedAsteroidsEnvironment
+    from drivers import create_batch_evaluator
+
+    environment = tf_py_environment.TFPyEnvironment(BatchedAsteroidsEnvironment(
+        num_episodes, frame_skip=frame_skip, metrics_prefix=None, dt=dt))
+    policy = policy_constructor(environment)
+    evaluate = create_batch_evaluator(environment, policy, max_steps)
+
+    stop = False
+    while not stop:
+        request = requests.get()
+        # Once evaluation falls behind training only the newest snapshot is worth evaluating
+        while True:
+            try:
+                newer = requests.get_nowait()
+            except queue.Empty:
+                break
+            if newer is None:
+                stop = True
+            else:
+                request = newer
+        if request is None:
+            break
+
+        step, weights = request
+        for variable, value in zip(policy.variables(), weights):
+            variable.assign(value)
+        results.put((step, evaluate()))
+
+
+class BackgroundEvaluator:
+    # Evaluates snapshots of a policy in a separate process on its own batch of num_episodes worlds.
+    # policy_constructor builds the same policy from a TFPyEnvironment there and has to be picklable
+    def __init__(self, policy_constructor, num_episodes=10, frame_skip=1, dt=None, max_steps=10000):
+        context = multiprocessing.get_context('spawn')
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        self._process = context.Process(
+            target=_worker, args=(self._requests, self._results, policy_constructor, num_episodes, frame_skip, dt,
+                                  max_steps), daemon=True)
+        self._process.start()
+
+    def _check_worker(self):
+        # A worker that died would leave snapshots piling up unread, and the exit waiting on them
+        if not self._process.is_alive():
+            raise RuntimeError(f"The background evaluator process died with exit code {self._process.exitcode}")
+
+    def submit(self, step, policy):
+        # Copies the weights out and returns at once, the result shows up in a later poll()
+        self._check_worker()
+        self._requests.put((int(step), [variable.numpy() for variable in policy.variables()]))
+
+    def poll(self):
+        self._check_worker()
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self, wait=True):
+        # With wait the last submitted snapshot is still evaluated and its result returned
+        results = []
+        if wait and self._process.is_alive():
+            self._requests.put(None)
+            while self._process.is_alive() or not self._results.empty():
+                try:
+                    results.append(self._results.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+        else:
+            self._process.terminate()
+        self._process.join()
+        if self._process.exitcode != 0:
+            # Nothing reads the requests any more, snapshots still queued must not block the interpreter's exit
+            self._requests.cancel_join_thread()
+        return results
@@ -0,0 +1,204 @@
+import math
+
+import numpy as np
+
+from headings import COS_ARRAY, SIN_ARRAY
+from profiling import profiler
+from timing import tick_timing
+
+
+class BatchedAsteroidsGame:
+    def __init__(self, batch_size, max_asteroids=64, max_bullets=32, seed=None, dt=None):
+        self.batch_size = batch_size
+        self.max_asteroids = max_asteroids
+        self.max_bullets = max_bullets
+        self._rng = np.random.default_rng(seed)
+
+        self.WIDTH, self.HEIGHT = 800, 600
+        self.FPS = 60
+
+        # Per frame at FPS like AsteroidsGame, each tick of dt seconds covers frames_per_tick frames
+        self.player_size = 50
+        self.player_speed = 5
+        self.turn_speed = 5
+        self.bullet_speed = 8
+        # A bullet hits an asteroid whose center is closer than this
+        self.hit_distance = 20
+        self.asteroid_speed = 1.3
+        self.asteroid_radius = 20
+        self.frame_spawn_chance = 2 / 101
+        self.collision_step = 10
+
+        timing = tick_timing(self, dt)
+        self.dt = timing.dt
+        self.frames_per_tick = timing.frames_per_tick
+        self.substeps = timing.substeps
+        self.player_step = timing.player_step
+        self.turn_step = timing.turn_step
+        self.bullet_step = timing.bullet_step
+        self.asteroid_step = timing.asteroid_step
+        self.spawn_frames = math.floor(self.frames_per_tick)
+        self.partial_spawn_chance = (self.frames_per_tick - self.spawn_frames) * self.frame_spawn_chance
+
+        n = batch_size
+        self.player_x = np.zeros(n, dtype=np.float64)
+        self.player_y = np.zeros(n, dtype=np.float64)
+        self.player_angle = np.zeros(n, dtype=np.int64)
+
+        self.bullet_x = np.zeros((n, max_bullets), dtype=np.float64)
+        self.bullet_y = np.zeros((n, max_bullets), dtype=np.float64)
+        self.bullet_vx = np.zeros((n, max_bullets), dtype=np.float64)
+        self.bullet_vy = np.zeros((n, max_bullets), dtype=np.float64)
+        self.bullet_alive = np.zeros((n, max_bullets), dtype=bool)
+
+        self.asteroid_x = np.zeros((n, max_asteroids), dtype=np.float64)
+        self.asteroid_y = np.zeros((n, max_asteroids), dtype=np.float64)
+        self.asteroid_vx = np.zeros((n, max_asteroids), dtype=np.float64)
+        self.asteroid_vy = np.zeros((n, max_asteroids), dtype=np.float64)
+        self.asteroid_alive = np.zeros((n, max_asteroids), dtype=bool)
+
+        timer_dtype = np.int64 if isinstance(self.frames_per_tick, int) else np.float64
+        self.game_timer = np.zeros(n, dtype=timer_dtype)
+        self.bullet_timer = np.zeros(n, dtype=timer_dtype)
+        self.player_score = np.zeros(n, dtype=np.int64)
+        self.game_over = np.zeros(n, dtype=bool)
+
+        self.reset()
+
+    def reset(self, mask=None):
+        if mask is None:
+            mask = np.ones(self.batch_size, dtype=bool)
+        self.player_x[mask] = self.WIDTH // 2
+        self.player_y[mask] = self.HEIGHT // 2
+        self.player_angle[mask] = 0
+        self.player_score[mask] = 0
+        self.asteroid_alive[mask] = False
+        self.bullet_alive[mask] = False
+        self.game_timer[mask] = 0
+        self.game_over[mask] = False
+
+    def apply_actions(self, actions, mask):
+        actions = np.asarray(actions).reshape(self.batch_size)
+        degrees = self.player_angle % 360
+
+        self.player_angle -= self.turn_step * (mask & (actions == 0))
+        self.player_angle += self.turn_step * (mask & (actions == 1))
+
+        thrust = (mask & (actions == 2)).astype(np.float64) - (mask & (actions == 3))
+        self.player_x += thrust * self.player_step * SIN_ARRAY[degrees]
+        self.player_y -= thrust * self.player_step * COS_ARRAY[degrees]
+
+        shoot = mask & (actions == 4) & (self.bullet_timer >= 5)
+        if shoot.any():
+            self.shoot_bullets(shoot)
+
+    def shoot_bullets(self, mask):
+        headings = (90 - self.player_angle) % 360
+        self._spawn(mask, self.bullet_alive, self.bullet_x, self.bullet_y, self.bullet_vx, self.bullet_vy,
+                    self.player_x, self.player_y,
+                    self.bullet_step * COS_ARRAY[headings], -self.bullet_step * SIN_ARRAY[headings])
+        self.bullet_timer[mask] = 0
+
+    def spawn_asteroids(self, mask):
+        headings = self._rng.integers(0, 361, size=self.batch_size) % 360
+        self._spawn(mask, self.asteroid_alive, self.asteroid_x, self.asteroid_y,
+                    self.asteroid_vx, self.asteroid_vy,
+                    self._rng.integers(0, self.WIDTH + 1, size=self.batch_size).astype(np.float64),
+                    self._rng.integers(0, self.HEIGHT + 1, size=self.batch_size).astype(np.float64),
+                    self.asteroid_step * COS_ARRAY[headings], -self.asteroid_step * SIN_ARRAY[headings])
+
+    def _spawn(self, mask, alive, x, y, vx, vy, new_x, new_y, new_vx, new_vy):
+        # A full world simply drops the new object
+        mask = mask & ~alive.all(axis=1)
+        rows = np.flatnonzero(mask)
+        slots = np.argmin(alive[rows], axis=1)
+        alive[rows, slots] = True
+        x[rows, slots] = new_x[rows]
+        y[rows, slots] = new_y[rows]
+        vx[rows, slots] = new_vx[rows]
+        vy[rows, slots] = new_vy[rows]
+
+    def _move(self, alive, x, y, vx, vy):
+        x += vx
+        y += vy
+        alive &= (x >= 0) & (x <= self.WIDTH) & (y >= 0) & (y <= self.HEIGHT)
+
+    def check_collisions(self, mask):
+        dx = self.asteroid_x - self.player_x[:, None]
+        dy = self.asteroid_y - self.player_y[:, None]
+        player_hit = self.asteroid_alive & (dx * dx + dy * dy < (self.player_size / 2 + self.asteroid_radius) ** 2)
+        self.game_over |= mask & player_hit.any(axis=1)
+
+        # [batch, bullet, asteroid] hit matrix
+        dx = self.bullet_x[:, :, None] - self.asteroid_x[:, None, :]
+        dy = self.bullet_y[:, :, None] - self.asteroid_y[:, None, :]
+        hits = (dx * dx + dy * dy < self.hit_distance ** 2)
+        hits &= self.bullet_alive[:, :, None] & self.asteroid_alive[:, None, :] & mask[:, None, None]
+
+        # Like AsteroidsGame, bullets in slot order each take the first asteroid in slot order that no earlier
+        # bullet took, so a bullet beaten to its asteroid can still hit another one it touches. Only the slots
+        # differ: they are reused first free here and swap-removed there
+        taken = np.zeros_like(self.asteroid_alive)
+        for bullet in np.flatnonzero(hits.any(axis=(0, 2))):
+            bullet_hits = hits[:, bullet] & ~taken
+            rows = np.flatnonzero(bullet_hits.any(axis=1))
+            taken[rows, np.argmax(bullet_hits[rows], axis=1)] = True
+            self.bullet_alive[rows, bullet] = False
+        self.asteroid_alive &= ~taken
+        self.player_score += taken.sum(axis=1)
+
+    def step(self, actions, mask=None):
+        if mask is None:
+            mask = ~self.game_over
+        self.apply_actions(actions, mask)
+
+        self.player_angle[mask] %= 360
+        self.player_x[mask] %= self.WIDTH
+        self.player_y[mask] %= self.HEIGHT
+
+        # Worlds outside the mask are waiting for a reset, so moving their objects is harmless.
+        # Large ticks move and collide in substeps, a world that collides sits out the rest of them
+        active = mask
+        for _ in range(self.substeps):
+            with profiler.phase('batched_game.move'):
+                self._move(self.bullet_alive, self.bullet_x, self.bullet_y, self.bullet_vx, self.bullet_vy)
+                self._move(self.asteroid_alive, self.asteroid_x, self.asteroid_y, self.asteroid_vx,
+                           self.asteroid_vy)
+            with profiler.phase('batched_game.check_collisions'):
+                self.check_collisions(active)
+            active = active & ~self.game_over
+
+        with profiler.phase('batched_game.spawn_asteroids'):
+            # As many asteroids as the tick's frames spawn, see AsteroidsGame.spawn_count
+            if self.frames_per_tick == 1:
+                count = self._rng.random(self.batch_size) < self.frame_spawn_chance
+            else:
+                count = self._rng.binomial(self.spawn_frames, self.frame_spawn_chance, self.batch_size)
+                if self.partial_spawn_chance:
+                    count += self._rng.random(self.batch_size) < self.partial_spawn_chance
+            count = np.where(mask, count, 0)
+            for spawned in range(count.max()):
+                self.spawn_asteroids(count > spawned)
+
+        self.bullet_timer += mask * self.frames_per_tick
+        self.game_timer += mask * self.frames_per_tick
+
+    def nearest_offsets(self, x, y, alive):
+        dx = x - self.player_x[:, None]
+        dy = y - self.player_y[:, None]
+        distance = np.where(alive, dx * dx + dy * dy, np.inf)
+        nearest = np.argmin(distance, axis=1)[:, None]
+        found = alive.any(axis=1)
+        # Worlds without objects report zero offsets
+        return (np.where(found, np.take_along_axis(dx, nearest, axis=1)[:, 0], 0.0),
+                np.where(found, np.take_along_axis(dy, nearest, axis=1)[:, 0], 0.0))
+
+    def get_observations(self, out=None):
+        if out is None:
+            out = np.zeros((self.batch_size, 7), dtype=np.float32)
+        out[:, 0] = self.player_x
+        out[:, 1] = self.player_y
+        out[:, 2] = self.player_angle
+        out[:, 3], out[:, 4] = self.nearest_offsets(self.asteroid_x, self.asteroid_y, self.asteroid_alive)
+        out[:, 5], out[:, 6] = self.nearest_offsets(self.bullet_x, self.bullet_y, self.bullet_alive)
+        return out
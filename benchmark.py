@@ -0,0 +1,407 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+# Objects kept alive in the world while a section is timed: (asteroids, bullets)
+DENSITIES = {
+    'sparse': (5, 2),
+    'medium': (25, 10),
+    'dense': (100, 30),
+}
+
+CHUNK_TICKS = 100
+
+
+def populate(game, num_asteroids, num_bullets, rng):
+    # Objects stand still and keep clear of the player and of each other, so the density
+    # stays fixed for a whole chunk instead of draining off-screen or into collisions
+    game.game_over = False
+    game.player_x = game.WIDTH // 2
+    game.player_y = game.HEIGHT // 2
+    game.player_angle = 0
+    game.asteroids.clear()
+    game.bullets.clear()
+
+    def free_position(min_player_distance, avoid, min_distance):
+        while True:
+            x = rng.uniform(0, game.WIDTH)
+            y = rng.uniform(0, game.HEIGHT)
+            if math.hypot(x - game.player_x, y - game.player_y) < min_player_distance:
+                continue
+            if all(math.hypot(x - other_x, y - other_y) >= min_distance for other_x, other_y in avoid):
+                return x, y
+
+    asteroids = [free_position(120, (), 0) for _ in range(num_asteroids)]
+    for x, y in asteroids:
+        game.asteroids.append(x, y, 0)
+    for _ in range(num_bullets):
+        x, y = free_position(60, asteroids, 30)
+        game.bullets.append(x, y, 0)
+
+
+def run_chunks(game, total_ticks, rng, density, tick, reset=None):
+    # reset clears the episode state of whatever wraps the game, so its next step does not reset the
+    # world just populated. A collision ends the episode, the world is refilled off the clock then
+    # instead of timing the rest of the chunk on an empty one
+    def refill():
+        if reset is not None:
+            reset()
+        populate(game, *density, rng)
+
+    elapsed = 0.0
+    chunks = max(1, total_ticks // CHUNK_TICKS)
+    for _ in range(chunks):
+        refill()
+        ticks = 0
+        while ticks < CHUNK_TICKS:
+            start = time.perf_counter()
+            while ticks < CHUNK_TICKS:
+                tick()
+                ticks += 1
+                if game.game_over:
+                    break
+            elapsed += time.perf_counter() - start
+            if game.game_over and ticks < CHUNK_TICKS:
+                refill()
+    return chunks * CHUNK_TICKS / elapsed
+
+
+def benchmark_game(ticks, seed, headless):
+    from asteroids import AsteroidsGame
+
+    results = {}
+    game = AsteroidsGame(headless=headless, seed=seed)
+    for name, density in DENSITIES.items():
+        game.random.seed(seed)
+        results[name] = run_chunks(game, ticks, random.Random(seed), density, game.render)
+    return results
+
+
+def benchmark_core(ticks, seed):
+    # AsteroidsCore.step without the tf_agents wrapper, so it runs without TensorFlow
+    from asteroids import AsteroidsGame
+    from asteroids_core import AsteroidsCore
+
+    results = {}
+    game = AsteroidsGame(headless=True, seed=seed)
+    core = AsteroidsCore(game, seed=seed, metrics_prefix=None)
+    for name, density in DENSITIES.items():
+        game.random.seed(seed)
+        actions = iter(np.random.default_rng(seed).integers(0, 5, size=ticks + CHUNK_TICKS).astype(np.int32))
+        results[name] = run_chunks(game, ticks, random.Random(seed), density, lambda: core.step(next(actions)),
+                                   reset=core.reset)
+    return results
+
+
+def benchmark_env(ticks, seed):
+    from asteroids import AsteroidsGame
+    from asteroids_env import AsteroidsEnvironment
+
+    results = {}
+    game = AsteroidsGame(headless=True, seed=seed)
+    env = AsteroidsEnvironment(game, seed=seed)
+    for name, density in DENSITIES.items():
+        game.random.seed(seed)
+        actions = iter(np.random.default_rng(seed).integers(0, 5, size=ticks + CHUNK_TICKS).astype(np.int32))
+        results[name] = run_chunks(game, ticks, random.Random(seed), density, lambda: env.step(next(actions)),
+                                   reset=env.reset)
+    return results
+
+
+def benchmark_collect(steps, seed):
+    import tensorflow as tf
+    from tf_agents.environments import tf_py_environment
+    from tf_agents.policies import random_tf_policy
+    from tf_agents.replay_buffers import tf_uniform_replay_buffer
+
+    import dqn_agent
+    import ppo_agent
+    from asteroids import AsteroidsGame
+    from asteroids_env import AsteroidsEnvironment, BatchedAsteroidsEnvironment
+    from drivers import create_collect_driver
+    from rollout_buffer import RolloutBuffer
+
+    def time_collect(collect, steps_per_run, clear=None):
+        # The first run traces the collect loop
+        collect()
+        runs = max(1, steps // steps_per_run)
+        start = time.perf_counter()
+        for _ in range(runs):
+            if clear:
+                clear()
+            collect()
+        return runs * steps_per_run / (time.perf_counter() - start)
+
+    tf.random.set_seed(seed)
+    results = {}
+    environments = {
+        'single': AsteroidsEnvironment(AsteroidsGame(headless=True, seed=seed), seed=seed),
+        'batched_8': BatchedAsteroidsEnvironment(8, seed=seed),
+    }
+    # Compiled runs of the DQN script's collect_steps_per_iteration steps each
+    steps_per_run = dqn_agent.collect_steps_per_iteration
+    for name, py_env in environments.items():
+        env = tf_py_environment.TFPyEnvironment(py_env)
+        policy = random_tf_policy.RandomTFPolicy(env.time_step_spec(), env.action_spec())
+        replay_buffer = tf_uniform_replay_buffer.TFUniformReplayBuffer(
+            data_spec=policy.trajectory_spec, batch_size=env.batch_size, max_length=steps + 2 * steps_per_run)
+        collect = create_collect_driver(env, policy, [replay_buffer.add_batch], steps_per_run)
+        # Env steps, so batched environments are credited for every world they advance
+        results[name] = time_collect(collect, steps_per_run) * env.batch_size
+
+    # PPO rollouts: one compiled run fills the rollout of all the training worlds
+    env = tf_py_environment.TFPyEnvironment(BatchedAsteroidsEnvironment(ppo_agent.num_parallel_environments, seed=seed))
+    agent = ppo_agent.create_agent(env)
+    rollout_buffer = RolloutBuffer(agent.collect_data_spec, env.batch_size, ppo_agent.rollout_length)
+    collect = create_collect_driver(env, agent.collect_policy, [rollout_buffer.graph_add_batch],
+                                    ppo_agent.rollout_length)
+    results['ppo_rollout'] = time_collect(collect, ppo_agent.rollout_length, rollout_buffer.clear) * env.batch_size
+    return results
+
+
+def time_train(train, next_experience, steps):
+    # The first call traces the graph
+    train(next_experience())
+    start = time.perf_counter()
+    for _ in range(steps):
+        train(next_experience())
+    return steps / (time.perf_counter() - start)
+
+
+def benchmark_train(steps, seed):
+    import tensorflow as tf
+    from tf_agents.environments import tf_py_environment
+    from tf_agents.replay_buffers import tf_uniform_replay_buffer
+    from tf_agents.utils import common
+
+    import dqn_agent
+    import ppo_agent
+    from asteroids_env import BatchedAsteroidsEnvironment
+    from drivers import create_collect_driver
+    from rollout_buffer import RolloutBuffer
+
+    tf.random.set_seed(seed)
+    results = {}
+
+    env = tf_py_environment.TFPyEnvironment(BatchedAsteroidsEnvironment(dqn_agent.num_parallel_environments, seed=seed))
+    agent = dqn_agent.create_agent(env, tf.Variable(0, dtype=tf.int64))
+    replay_buffer = tf_uniform_replay_buffer.TFUniformReplayBuffer(
+        data_spec=agent.collect_data_spec, batch_size=env.batch_size,
+        max_length=dqn_agent.replay_max_length(env.batch_size))
+    create_collect_driver(env, agent.collect_policy, [replay_buffer.add_batch], dqn_agent.batch_size)()
+    iterator = iter(replay_buffer.as_dataset(
+        num_parallel_calls=3, sample_batch_size=dqn_agent.batch_size,
+        num_steps=dqn_agent.n_step_update + 1).prefetch(3))
+    results['dqn'] = time_train(common.function(agent.train), lambda: next(iterator)[0], steps)
+
+    # PPO trains on one whole rollout per step, the same one every time here
+    env = tf_py_environment.TFPyEnvironment(BatchedAsteroidsEnvironment(ppo_agent.num_parallel_environments, seed=seed))
+    agent = ppo_agent.create_agent(env)
+    rollout_buffer = RolloutBuffer(agent.collect_data_spec, env.batch_size, ppo_agent.rollout_length)
+    create_collect_driver(env, agent.collect_policy, [rollout_buffer.graph_add_batch], ppo_agent.rollout_length)()
+    experience = rollout_buffer.gather_all()
+    results['ppo'] = time_train(common.function(agent.train), lambda: experience, steps)
+    return results
+
+
+def benchmark_inference(requests, seed, clients=32):
+    # Actions/s for callers that each need one action at a time: every caller calling the policy on its own
+    # batch of one, against clients threads sharing an InferenceServer
+    import threading
+
+    import tensorflow as tf
+    from tf_agents.environments import tf_py_environment
+
+    import dqn_agent
+    from asteroids_env import BatchedAsteroidsEnvironment
+    from inference_server import InferenceServer, batched_actions
+
+    tf.random.set_seed(seed)
+    rng = np.random.default_rng(seed)
+    env = tf_py_environment.TFPyEnvironment(BatchedAsteroidsEnvironment(1, seed=seed, metrics_prefix=None))
+    choose_actions = batched_actions(dqn_agent.create_eval_policy(env))
+    observations = rng.uniform(-400, 400, size=(requests,) + env.observation_spec().shape).astype(np.float32)
+    first = np.zeros(1, dtype=bool)
+
+    results = {}
+    choose_actions(observations[:1], first)
+    start = time.perf_counter()
+    for observation in observations:
+        choose_actions(observation[None], first)
+    results['single'] = requests / (time.perf_counter() - start)
+
+    server = InferenceServer(choose_actions, env.observation_spec().shape, metrics_prefix=None)
+    server.warmup()
+
+    def client(index):
+        session = server.connect()
+        for observation in observations[index::clients]:
+            session.action(observation)
+        session.close()
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results['server'] = requests / (time.perf_counter() - start)
+    stats = server.stats()
+    server.close()
+    print(f"{clients} clients: mean batch size {stats['mean_batch_size']:.1f}, "
+          f"latency p50 {stats['latency_p50_ms']:.2f} ms p99 {stats['latency_p99_ms']:.2f} ms")
+    return results
+
+
+def benchmark_replay(steps, seed):
+    import tempfile
+
+    import tensorflow as tf
+
+    import dqn_agent
+    from mmap_replay_buffer import MemmapReplayBuffer
+    from prioritized_replay import PrioritizedReplayBuffer
+
+    # The DQN script's replay capacity and batch, filled with windows of random transitions
+    num_envs = dqn_agent.num_parallel_environments
+    max_length = dqn_agent.replay_max_length(num_envs)
+    num_steps = dqn_agent.n_step_update + 1
+    data_spec = {
+        'observation': tf.TensorSpec((7,), tf.float32),
+        'action': tf.TensorSpec((), tf.int32),
+        'reward': tf.TensorSpec((), tf.float32),
+        'discount': tf.TensorSpec((), tf.float32),
+        'step_type': tf.TensorSpec((), tf.int32),
+    }
+    rng = np.random.default_rng(seed)
+    batch = {
+        'observation': rng.random((num_envs, 7), dtype=np.float32),
+        'action': np.zeros(num_envs, dtype=np.int32),
+        'reward': np.ones(num_envs, dtype=np.float32),
+        'discount': np.ones(num_envs, dtype=np.float32),
+        'step_type': np.ones(num_envs, dtype=np.int32),
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        uniform = MemmapReplayBuffer(data_spec, num_envs, max_length, os.path.join(directory, 'uniform'), seed=seed)
+        prioritized = PrioritizedReplayBuffer(data_spec, num_envs, max_length, os.path.join(directory, 'prioritized'),
+                                              num_steps=num_steps, seed=seed)
+        for _ in range(max_length):
+            uniform.add_batch(batch)
+            prioritized.add_batch(batch)
+
+        for name, replay_buffer in (('uniform', uniform), ('prioritized', prioritized)):
+            start = time.perf_counter()
+            for _ in range(steps):
+                replay_buffer.sample(dqn_agent.batch_size, num_steps)
+            results[f"{name}_sample"] = steps / (time.perf_counter() - start)
+
+        _, info = prioritized.sample(dqn_agent.batch_size, num_steps)
+        losses = rng.random((steps, dqn_agent.batch_size))
+        start = time.perf_counter()
+        for step_losses in losses:
+            prioritized.update_priorities(info.ids, step_losses)
+        results['prioritized_update'] = steps / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            prioritized.add_batch(batch)
+        results['prioritized_add'] = steps / (time.perf_counter() - start)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for section, values in results['results'].items():
+        for name, value in values.items():
+            previous = baseline.get('results', {}).get(section, {}).get(name)
+            if previous:
+                ratio = value / previous
+                marker = '  REGRESSION' if ratio < tolerance else ''
+                print(f"{section:>16} {name:>10} {previous:>12.1f} -> {value:>12.1f} ({ratio:>5.2f}x){marker}")
+                if ratio < tolerance:
+                    regressions.append(f"{section}/{name}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Throughput benchmarks for the Asteroids game, env and agents')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ticks', type=int, default=5000, help='game ticks / env steps per density')
+    parser.add_argument('--collect-steps', type=int, default=500)
+    parser.add_argument('--train-steps', type=int, default=50)
+    parser.add_argument('--replay-steps', type=int, default=2000, help='replay buffer samples, updates and adds')
+    parser.add_argument('--inference-requests', type=int, default=5000)
+    parser.add_argument('--skip-tf', action='store_true', help='only run the sections that do not need TensorFlow')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.9,
+                        help='flag sections slower than this fraction of the baseline')
+    args = parser.parse_args(argv)
+
+    # The rendered section needs a display surface, a dummy one is enough to time drawing
+    if not os.environ.get('DISPLAY'):
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+    results = {}
+    print('Timing AsteroidsGame.update (headless)')
+    results['game_headless'] = benchmark_game(args.ticks, args.seed, headless=True)
+    print('Timing AsteroidsGame.update (rendered)')
+    results['game_rendered'] = benchmark_game(args.ticks, args.seed, headless=False)
+    print('Timing AsteroidsCore.step')
+    results['core_step'] = benchmark_core(args.ticks, args.seed)
+    if not args.skip_tf:
+        print('Timing AsteroidsEnvironment.step')
+        results['env_step'] = benchmark_env(args.ticks, args.seed)
+        print('Timing compiled collect drivers through TFPyEnvironment')
+        results['tf_collect_step'] = benchmark_collect(args.collect_steps, args.seed)
+        print('Timing agent train steps')
+        results['agent_train_step'] = benchmark_train(args.train_steps, args.seed)
+        print('Timing uniform and prioritized replay at the DQN capacity and batch size')
+        results['replay'] = benchmark_replay(args.replay_steps, args.seed)
+        print('Timing policy actions one call per request against a batching InferenceServer')
+        results['inference'] = benchmark_inference(args.inference_requests, args.seed)
+
+    report = {
+        'config': {
+            'seed': args.seed,
+            'ticks': args.ticks,
+            'collect_steps': args.collect_steps,
+            'train_steps': args.train_steps,
+            'replay_steps': args.replay_steps,
+            'inference_requests': args.inference_requests,
+            'densities': DENSITIES,
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+        },
+        'units': 'per second',
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for section, values in results.items():
+        for name, value in values.items():
+            print(f"{section:>16} {name:>10} {value:>12.1f}/s")
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import math
+import random
+import time
+
+from asteroids import AsteroidsGame
+
+ASTEROID_COUNTS = (10, 100, 1000)
+BULLET_COUNT = 32
+REPEATS = 200
+
+
+def all_pairs_collisions(game, asteroids, bullets):
+    # The original check_collisions loop over lists, kept as the reference for the grid broad phase. It walks a
+    # copy of the bullets, removing from the list it iterates would skip the bullet after every hit
+    for asteroid in asteroids:
+        distance = math.sqrt((game.player_x - asteroid[0]) ** 2 + (game.player_y - asteroid[1]) ** 2)
+        if distance < game.player_size / 2 + 20:
+            game.game_over = True
+
+    for bullet in list(bullets):
+        for asteroid in asteroids:
+            distance = math.sqrt((bullet[0] - asteroid[0]) ** 2 + (bullet[1] - asteroid[1]) ** 2)
+            if distance < 20:
+                bullets.remove(bullet)
+                asteroids.remove(asteroid)
+                game.player_score += 1
+                break
+
+
+def random_world(game, num_asteroids, seed):
+    rng = random.Random(seed)
+    asteroids = [[rng.uniform(0, game.WIDTH), rng.uniform(0, game.HEIGHT), rng.randint(0, 360)]
+                 for _ in range(num_asteroids)]
+    bullets = [[rng.uniform(0, game.WIDTH), rng.uniform(0, game.HEIGHT), rng.randint(0, 360)]
+               for _ in range(BULLET_COUNT)]
+    return asteroids, bullets
+
+
+def load_world(game, asteroids, bullets):
+    game.asteroids.clear()
+    game.bullets.clear()
+    for asteroid in asteroids:
+        game.asteroids.append(*asteroid)
+    for bullet in bullets:
+        game.bullets.append(*bullet)
+    game.player_score = 0
+
+
+def remaining(pool):
+    return sorted(zip(pool.x[:pool.size], pool.y[:pool.size]))
+
+
+def check_same_hits(game, num_asteroids):
+    # Both paths have to remove the same bullets and asteroids, or the timings compare different work
+    for repeat in range(REPEATS):
+        asteroids, bullets = random_world(game, num_asteroids, repeat)
+        load_world(game, asteroids, bullets)
+        game.check_collisions()
+        all_pairs_collisions(game, asteroids, bullets)
+        assert sorted((x, y) for x, y, _ in asteroids) == remaining(game.asteroids), \
+            f"all-pairs and grid hit different asteroids in world {repeat} of {num_asteroids}"
+        assert sorted((x, y) for x, y, _ in bullets) == remaining(game.bullets), \
+            f"all-pairs and grid hit with different bullets in world {repeat} of {num_asteroids}"
+
+
+def time_collisions(game, num_asteroids, all_pairs):
+    elapsed = 0.0
+    score = 0
+    for repeat in range(REPEATS):
+        asteroids, bullets = random_world(game, num_asteroids, repeat)
+        load_world(game, asteroids, bullets)
+
+        start = time.perf_counter()
+        if all_pairs:
+            all_pairs_collisions(game, asteroids, bullets)
+        else:
+            game.check_collisions()
+        elapsed += time.perf_counter() - start
+        score += game.player_score
+    return elapsed / REPEATS, score
+
+
+def main():
+    game = AsteroidsGame(headless=True)
+    print(f"{'asteroids':>10} {'all-pairs':>12} {'grid':>12} {'speedup':>8} {'hits':>12}")
+    for num_asteroids in ASTEROID_COUNTS:
+        check_same_hits(game, num_asteroids)
+        all_pairs_time, all_pairs_score = time_collisions(game, num_asteroids, all_pairs=True)
+        grid_time, grid_score = time_collisions(game, num_asteroids, all_pairs=False)
+        print(f"{num_asteroids:>10} {all_pairs_time * 1e6:>10.1f}us {grid_time * 1e6:>10.1f}us "
+              f"{all_pairs_time / grid_time:>7.1f}x {all_pairs_score:>5}/{grid_score:<6}")
+
+
+if __name__ == '__main__':
+    main()
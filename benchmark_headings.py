@@ -0,0 +1,70 @@
+import math
+import random
+import timeit
+
+from asteroids import AsteroidsGame
+from headings import heading_velocity
+
+OBJECT_COUNTS = (10, 100, 1000)
+REPEATS = 200
+
+
+def trig_move(objects, speed):
+    # Per-frame motion as it was before headings were cached: two trig calls per object
+    for obj in objects:
+        obj[0] += speed * math.cos(math.radians(obj[2]))
+        obj[1] -= speed * math.sin(math.radians(obj[2]))
+
+
+def cached_move(xs, ys, vxs, vys):
+    for i in range(len(xs)):
+        xs[i] += vxs[i]
+        ys[i] += vys[i]
+
+
+def trig_player_points(game):
+    player_points = [
+        (game.player_x, game.player_y - game.player_size // 1.5),
+        (game.player_x + game.player_size // 2, game.player_y + game.player_size // 2),
+        (game.player_x - game.player_size // 2, game.player_y + game.player_size // 2)
+    ]
+    return [
+        (
+            game.player_x + (point[0] - game.player_x) * math.cos(math.radians(game.player_angle)) - (
+                    point[1] - game.player_y) * math.sin(math.radians(game.player_angle)),
+            game.player_y + (point[0] - game.player_x) * math.sin(math.radians(game.player_angle)) + (
+                    point[1] - game.player_y) * math.cos(math.radians(game.player_angle))
+        )
+        for point in player_points
+    ]
+
+
+def per_call_us(statement):
+    return min(timeit.repeat(statement, number=REPEATS, repeat=5)) / REPEATS * 1e6
+
+
+def main():
+    rng = random.Random(0)
+    game = AsteroidsGame(headless=True)
+
+    print(f"{'objects':>8} {'trig move':>12} {'cached move':>12} {'speedup':>8}")
+    for count in OBJECT_COUNTS:
+        objects = [[rng.uniform(0, 800), rng.uniform(0, 600), rng.randint(0, 360)] for _ in range(count)]
+        velocities = [heading_velocity(obj[2], game.asteroid_speed) for obj in objects]
+        xs = [obj[0] for obj in objects]
+        ys = [obj[1] for obj in objects]
+        vxs = [vx for vx, _ in velocities]
+        vys = [vy for _, vy in velocities]
+
+        trig = per_call_us(lambda: trig_move(objects, game.asteroid_speed))
+        cached = per_call_us(lambda: cached_move(xs, ys, vxs, vys))
+        print(f"{count:>8} {trig:>10.1f}us {cached:>10.1f}us {trig / cached:>7.1f}x")
+
+    game.player_angle = 35
+    trig = per_call_us(lambda: trig_player_points(game))
+    cached = per_call_us(game.get_player_points)
+    print(f"{'ship':>8} {trig:>10.2f}us {cached:>10.2f}us {trig / cached:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,14 @@ from __future__ import division
 from __future__ import print_function
 
 import sys
+import time
 
-import matplotlib.pyplot as plt
 import tensorflow as tf
 import os
 
 from tf_agents.agents.categorical_dqn import categorical_dqn_agent
-from tf_agents.drivers import dynamic_step_driver
+from tf_agents.agents.dqn.dqn_agent import DqnLossInfo
+from tf_agents.agents.tf_agent import LossInfo
 from tf_agents.environments import suite_gym
 from tf_agents.environments import tf_py_environment
 from tf_agents.eval import metric_utils
@@ -19,8 +20,16 @@ from tf_agents.policies import random_tf_policy
 from tf_agents.replay_buffers import tf_uniform_replay_buffer
 from tf_agents.trajectories import trajectory
 from tf_agents.utils import common
-from asteroids_env import AsteroidsEnvironment
+from tf_agents.utils import value_ops
+from asteroids_env import AsteroidsEnvironment, BatchedAsteroidsEnvironment
 from asteroids import AsteroidsGame
+from parallel_env import ProcessPoolEnvironment
+from mmap_replay_buffer import MemmapReplayBuffer
+from prioritized_replay import PrioritizedReplayBuffer
+from background_eval import BackgroundEvaluator
+from drivers import create_collect_driver, create_return_evaluator
+from metrics import metrics
+from profiling import profiler
 import numpy as np
 import pygame
 
@@ -28,6 +37,7 @@ num_iterations = 50000
 
 initial_collect_steps = 15
 collect_steps_per_iteration = 15
+# Transitions kept across all training worlds together
 replay_buffer_capacity = 100000
 
 fc_layer_params = (100,)
@@ -45,181 +55,317 @@ n_step_update = 2
 num_eval_episodes = 10
 eval_interval = 1000
 
-# Create an instance using gym.make
-env = AsteroidsEnvironment(AsteroidsGame())
-
-env.reset()
-
-print('Observation Spec:')
-print(env.time_step_spec().observation)
-print('Action Spec:')
-print(env.action_spec())
-
-time_step = env.reset()
-print('Time step:')
-print(time_step)
-
-action = np.array(1, dtype=np.int32)
-
-next_time_step = env.step(action)
-print('Next time step:')
-print(next_time_step)
-
-train_py_env = env
-eval_py_env = env
-
-train_env = tf_py_environment.TFPyEnvironment(train_py_env)
-eval_env = tf_py_environment.TFPyEnvironment(eval_py_env)
-
-categorical_q_net = categorical_q_network.CategoricalQNetwork(
-    train_env.observation_spec(),
-    train_env.action_spec(),
-    num_atoms=num_atoms,
-    fc_layer_params=fc_layer_params)
-
-optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=learning_rate)
-
-#train_step_counter = tf.compat.v2.Variable(0)
-
-global_step = tf.compat.v1.train.get_or_create_global_step()
-
-agent = categorical_dqn_agent.CategoricalDqnAgent(
-    train_env.time_step_spec(),
-    train_env.action_spec(),
-    categorical_q_network=categorical_q_net,
-    optimizer=optimizer,
-    min_q_value=min_q_value,
-    max_q_value=max_q_value,
-    n_step_update=n_step_update,
-    td_errors_loss_fn=common.element_wise_squared_loss,
-    gamma=gamma,
-    train_step_counter=global_step)
-
-agent.initialize()
-
-
-def compute_avg_return(environment, policy, num_episodes=10):
-    total_return = 0.0
-    for _ in range(num_episodes):
-
-        time_step = environment.reset()
-        episode_return = 0.0
-
-        while not time_step.is_last():
-            action_step = policy.action(time_step)
-            time_step = environment.step(action_step.action)
-            episode_return += time_step.reward
-        total_return += episode_return
-
-    avg_return = total_return / num_episodes
-    return avg_return.numpy()[0]
-
-
-random_policy = random_tf_policy.RandomTFPolicy(train_env.time_step_spec(),
-                                                train_env.action_spec())
-
-compute_avg_return(eval_env, random_policy, num_eval_episodes)
-
-# Please also see the metrics module for standard implementations of different
-# metrics.
-
-replay_buffer = tf_uniform_replay_buffer.TFUniformReplayBuffer(
-    data_spec=agent.collect_data_spec,
-    batch_size=train_env.batch_size,
-    max_length=replay_buffer_capacity)
-
-
-def collect_step(environment, policy):
-    time_step = environment.current_time_step()
-    action_step = policy.action(time_step)
-    next_time_step = environment.step(action_step.action)
-    traj = trajectory.from_transition(time_step, action_step, next_time_step)
-
-    # Add trajectory to the replay buffer
-    replay_buffer.add_batch(traj)
-
-
-for _ in range(initial_collect_steps):
-    collect_step(train_env, random_policy)
-
-# This loop is so common in RL, that we provide standard implementations of
-# these. For more details see the drivers module.
-
-# Dataset generates trajectories with shape [BxTx...] where
-# T = n_step_update + 1.
-dataset = replay_buffer.as_dataset(
-    num_parallel_calls=3, sample_batch_size=batch_size,
-    num_steps=n_step_update + 1).prefetch(3)
-
-iterator = iter(dataset)
-
-# (Optional) Optimize by wrapping some of the code in a graph using TF function.
-agent.train = common.function(agent.train)
-
-# Reset the train step
-agent.train_step_counter.assign(0)
-
-# Evaluate the agent's policy once before training.
-avg_return = compute_avg_return(eval_env, agent.policy, num_eval_episodes)
-returns = [avg_return]
-
-policy_dir = 'saved_policy'
-
-# load the policy
-#saved_policy = tf.compat.v2.saved_model.load(policy_dir)
-
-checkpoint_dir = os.path.join(policy_dir, 'checkpoint')
-train_checkpointer = common.Checkpointer(
-    ckpt_dir=checkpoint_dir,
-    max_to_keep=4,
-    agent=agent,
-    policy=agent.policy,
-    collect_policy=agent.collect_policy,
-    replay_buffer=replay_buffer,
-    global_step=global_step
-)
-
-if train_checkpointer.checkpoint_exists:
-    train_checkpointer.initialize_or_restore()
-    global_step = tf.compat.v1.train.get_global_step()
-    print(f"Checkpoint restored from {checkpoint_dir}")
-else:
-    print(f"Checkpoint not found in {checkpoint_dir}")
-
-try:
-    for _ in range(num_iterations):
-        # Collect a few steps using collect_policy and save to the replay buffer.
-        for _ in range(collect_steps_per_iteration):
-            collect_step(train_env, agent.collect_policy)
-
-        # Sample a batch of data from the buffer and update the agent's network.
-        experience, unused_info = next(iterator)
-        train_loss = agent.train(experience).loss
-
-        step = agent.train_step_counter.numpy()
-
-        if step % log_interval == 0:
-            print('step = {0}: loss = {1}'.format(step, train_loss))
+# Skip the pygame window and all drawing while training
+headless = True
+
+# Worlds stepped together by the vectorized training environment
+num_parallel_environments = 8
+# Host the training worlds in worker processes instead of the in-process vectorized engine
+use_process_pool = False
+# Game ticks each chosen action is repeated for
+frame_skip = 1
+# Simulated seconds per game tick, None for one 1/60 s frame. Coarser ticks simulate a second in fewer ticks,
+# collisions are then checked in substeps
+dt = None
+
+# Keep the replay buffer in memory-mapped files here rather than in every checkpoint, None keeps it in memory
+replay_buffer_dir = os.path.join('saved_policy', 'replay_buffer')
+
+# Sample windows in proportion to their last training loss rather than uniformly, needs replay_buffer_dir
+prioritized_replay = True
+priority_alpha = 0.6
+# Importance-sampling exponent, annealed from this to 1 over num_iterations
+priority_beta = 0.4
+
+# Evaluate policy snapshots in a separate process, on its own batch of num_eval_episodes worlds,
+# instead of stopping training for every evaluation
+background_evaluation = True
+
+# Episode, evaluation and training metrics are flushed here every metrics_flush_seconds by a background thread,
+# as any of 'csv', 'jsonl' and 'tensorboard'
+metrics_dir = os.path.join('saved_policy', 'metrics')
+metrics_formats = ('csv', 'tensorboard')
+metrics_flush_seconds = 10.0
+# 0 keeps the console quiet while training, 1 prints a metrics summary per flush, 2 also prints every record
+verbosity = 1
+
+# Time the game, env and training phases and print p50/p99 tables every profile_dump_seconds
+profile_phases = False
+profile_dump_seconds = 60
+
+
+class PrioritizedCategoricalDqnAgent(categorical_dqn_agent.CategoricalDqnAgent):
+    # The stock agent ignores importance weights and reports no per-sample loss. This one weights each
+    # sample's cross-entropy and returns it as td_loss for the priority updates. Only covers the
+    # feed-forward network without action constraints that this script trains
+    def _loss(self, experience, td_errors_loss_fn=None, gamma=1.0, reward_scale_factor=1.0, weights=None,
+              training=False):
+        first_two_steps = tf.nest.map_structure(lambda x: x[:, :2], experience)
+        last_two_steps = tf.nest.map_structure(lambda x: x[:, -2:], experience)
+        time_steps, policy_steps, _ = trajectory.experience_to_transitions(first_two_steps, True)
+        _, _, next_time_steps = trajectory.experience_to_transitions(last_two_steps, True)
+
+        q_logits, _ = self._q_network(time_steps.observation, step_type=time_steps.step_type, training=training)
+        next_q_distribution = self._next_q_distribution(next_time_steps)
+
+        # n-step return plus the discounted support of the last step, projected back onto the support
+        rewards = reward_scale_factor * experience.reward[:, :-1]
+        discounts = gamma * experience.discount[:, :-1]
+        discounted_returns = value_ops.discounted_return(
+            rewards=rewards, discounts=discounts, final_value=tf.zeros_like(rewards[:, 0]), time_major=False,
+            provide_all_returns=False)
+        target_support = discounted_returns[:, None] + tf.reduce_prod(discounts, axis=1)[:, None] * self._support
+        target_distribution = tf.stop_gradient(categorical_dqn_agent.project_distribution(
+            target_support, next_q_distribution, self._support))
+
+        actions = tf.cast(policy_steps.action, tf.int32)
+        chosen_action_logits = tf.gather(q_logits, actions, axis=1, batch_dims=1)
+        critic_loss = tf.nn.softmax_cross_entropy_with_logits(labels=target_distribution, logits=chosen_action_logits)
+
+        aggregated = common.aggregate_losses(per_example_loss=critic_loss, sample_weight=weights,
+                                             regularization_loss=self._q_network.losses)
+        return LossInfo(aggregated.total_loss, DqnLossInfo(td_loss=critic_loss, td_error=critic_loss))
+
+
+def create_agent(train_env, train_step_counter):
+    categorical_q_net = categorical_q_network.CategoricalQNetwork(
+        train_env.observation_spec(),
+        train_env.action_spec(),
+        num_atoms=num_atoms,
+        fc_layer_params=fc_layer_params)
+
+    optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=learning_rate)
+
+    agent_class = PrioritizedCategoricalDqnAgent if prioritized_replay else categorical_dqn_agent.CategoricalDqnAgent
+    agent = agent_class(
+        train_env.time_step_spec(),
+        train_env.action_spec(),
+        categorical_q_network=categorical_q_net,
+        optimizer=optimizer,
+        min_q_value=min_q_value,
+        max_q_value=max_q_value,
+        n_step_update=n_step_update,
+        td_errors_loss_fn=common.element_wise_squared_loss,
+        gamma=gamma,
+        train_step_counter=train_step_counter)
+
+    agent.initialize()
+    return agent
+
+
+def replay_max_length(batch_size):
+    # The replay buffers hold max_length steps of every world, together replay_buffer_capacity transitions
+    return max(1, replay_buffer_capacity // batch_size)
+
+
+def create_eval_policy(eval_env):
+    # Built again inside the background evaluator, which then loads the learner's weights into it
+    return create_agent(eval_env, tf.Variable(0, dtype=tf.int64)).policy
+
+
+def main():
+    if prioritized_replay and not replay_buffer_dir:
+        raise ValueError("prioritized_replay needs a replay_buffer_dir, the prioritized buffer is memory-mapped")
+    if profile_phases:
+        profiler.enable()
+    metrics.start(metrics_dir, metrics_formats, metrics_flush_seconds, verbosity)
+
+    # Create an instance using gym.make
+    env = AsteroidsEnvironment(AsteroidsGame(headless=headless, dt=dt), frame_skip=frame_skip,
+                               metrics_prefix='eval_episode/')
+
+    env.reset()
+
+    print('Observation Spec:')
+    print(env.time_step_spec().observation)
+    print('Action Spec:')
+    print(env.action_spec())
+
+    time_step = env.reset()
+    print('Time step:')
+    print(time_step)
+
+    action = np.array(1, dtype=np.int32)
+
+    next_time_step = env.step(action)
+    print('Next time step:')
+    print(next_time_step)
+
+    if use_process_pool:
+        train_py_env = ProcessPoolEnvironment(num_parallel_environments,
+                                              core_options={'frame_skip': frame_skip, 'dt': dt})
+    else:
+        train_py_env = BatchedAsteroidsEnvironment(num_parallel_environments, frame_skip=frame_skip, dt=dt)
+    # The process pool holds worker processes and shared memory, both go away with it however training ends
+    try:
+        eval_py_env = env
+
+        train_env = tf_py_environment.TFPyEnvironment(train_py_env)
+        eval_env = tf_py_environment.TFPyEnvironment(eval_py_env)
+
+        global_step = tf.compat.v1.train.get_or_create_global_step()
+
+        agent = create_agent(train_env, global_step)
+
+        random_policy = random_tf_policy.RandomTFPolicy(train_env.time_step_spec(),
+                                                        train_env.action_spec())
+
+        # Please also see the metrics module for standard implementations of different
+        # metrics.
+
+        if prioritized_replay:
+            replay_buffer = PrioritizedReplayBuffer(
+                data_spec=agent.collect_data_spec,
+                batch_size=train_env.batch_size,
+                max_length=replay_max_length(train_env.batch_size),
+                directory=replay_buffer_dir,
+                num_steps=n_step_update + 1,
+                alpha=priority_alpha,
+                beta=priority_beta)
+        elif replay_buffer_dir:
+            replay_buffer = MemmapReplayBuffer(
+                data_spec=agent.collect_data_spec,
+                batch_size=train_env.batch_size,
+                max_length=replay_max_length(train_env.batch_size),
+                directory=replay_buffer_dir)
+        else:
+            replay_buffer = tf_uniform_replay_buffer.TFUniformReplayBuffer(
+                data_spec=agent.collect_data_spec,
+                batch_size=train_env.batch_size,
+                max_length=replay_max_length(train_env.batch_size))
+        if replay_buffer_dir:
+            print(f"Replay buffer in {replay_buffer_dir} holds {replay_buffer.num_frames()} frames")
+
+        # The NumPy buffers are written through tf.numpy_function from inside the compiled collect loop
+        observers = [replay_buffer.graph_add_batch if replay_buffer_dir else replay_buffer.add_batch]
+        create_collect_driver(train_env, random_policy, observers, initial_collect_steps)()
+        collect = create_collect_driver(train_env, agent.collect_policy, observers, collect_steps_per_iteration)
+
+        # This loop is so common in RL, that we provide standard implementations of
+        # these. For more details see the drivers module.
+
+        # Dataset generates trajectories with shape [BxTx...] where
+        # T = n_step_update + 1.
+        dataset = replay_buffer.as_dataset(
+            num_parallel_calls=3, sample_batch_size=batch_size,
+            num_steps=n_step_update + 1).prefetch(3)
+
+        iterator = iter(dataset)
+
+        # (Optional) Optimize by wrapping some of the code in a graph using TF function.
+        agent.train = common.function(agent.train)
+
+        # Reset the train step
+        agent.train_step_counter.assign(0)
+
+        evaluator = None
+        if background_evaluation:
+            evaluator = BackgroundEvaluator(create_eval_policy, num_eval_episodes, frame_skip=frame_skip, dt=dt)
+        else:
+            compute_avg_return = create_return_evaluator(eval_env, agent.policy, num_eval_episodes)
+
+        def report_returns(results):
+            for eval_step, avg_return in results:
+                metrics.record('eval/average_return', avg_return, eval_step)
+
+        def evaluate(eval_step):
+            if evaluator:
+                evaluator.submit(eval_step, agent.policy)
+            else:
+                with profiler.phase('train.compute_avg_return'):
+                    report_returns([(eval_step, compute_avg_return())])
+
+        # Evaluate the agent's policy once before training.
+        evaluate(agent.train_step_counter.numpy())
+
+        policy_dir = 'saved_policy'
+
+        # load the policy
+        #saved_policy = tf.compat.v2.saved_model.load(policy_dir)
+
+        checkpoint_dir = os.path.join(policy_dir, 'checkpoint')
+        # An on-disk replay buffer persists by itself, only an in-memory one goes into the checkpoint
+        checkpointed_buffer = {} if replay_buffer_dir else {'replay_buffer': replay_buffer}
+        train_checkpointer = common.Checkpointer(
+            ckpt_dir=checkpoint_dir,
+            max_to_keep=4,
+            agent=agent,
+            policy=agent.policy,
+            collect_policy=agent.collect_policy,
+            global_step=global_step,
+            **checkpointed_buffer
+        )
+
+        def save_checkpoint():
             train_checkpointer.save(global_step)
+            if replay_buffer_dir:
+                replay_buffer.checkpoint()
+
+        if train_checkpointer.checkpoint_exists:
+            train_checkpointer.initialize_or_restore()
+            global_step = tf.compat.v1.train.get_global_step()
+            print(f"Checkpoint restored from {checkpoint_dir}")
+        else:
+            print(f"Checkpoint not found in {checkpoint_dir}")
+
+        collected_steps = 0
+        collect_seconds = 0.0
+        try:
+            for _ in range(num_iterations):
+                # Collect a few steps using collect_policy and save to the replay buffer.
+                start = time.perf_counter()
+                with profiler.phase('train.collect_step'):
+                    collect()
+                collect_seconds += time.perf_counter() - start
+                collected_steps += train_env.batch_size * collect_steps_per_iteration
+
+                # Sample a batch of data from the buffer and update the agent's network.
+                with profiler.phase('train.agent_train'):
+                    experience, info = next(iterator)
+                    if prioritized_replay:
+                        loss_info = agent.train(experience, weights=info.weights)
+                        replay_buffer.update_priorities(info.ids.numpy(), loss_info.extra.td_loss.numpy())
+                        progress = min(1.0, agent.train_step_counter.numpy() / num_iterations)
+                        replay_buffer.beta = priority_beta + (1.0 - priority_beta) * progress
+                    else:
+                        loss_info = agent.train(experience)
+                    train_loss = loss_info.loss
+
+                step = agent.train_step_counter.numpy()
+                metrics.set_step(step)
+                metrics.record('train/loss', float(train_loss))
+                profiler.dump_every(profile_dump_seconds)
+
+                if step % log_interval == 0:
+                    metrics.record('train/env_steps_per_sec', collected_steps / collect_seconds)
+                    collected_steps = 0
+                    collect_seconds = 0.0
+                    save_checkpoint()
+
+                if step % eval_interval == 0:
+                    evaluate(step)
+                if evaluator:
+                    report_returns(evaluator.poll())
+
+            if evaluator:
+                report_returns(evaluator.close())
+            metrics.close()
+
+            save_checkpoint()
+            print(f"Training ended, checkpoint saved to {checkpoint_dir}")
+
+        except KeyboardInterrupt:
+            print("Interrupted")
+            if evaluator:
+                evaluator.close(wait=False)
+            metrics.close()
+            save_checkpoint()
             print(f"Checkpoint saved to {checkpoint_dir}")
+            pygame.quit()
+            sys.exit(0)
+    finally:
+        train_py_env.close()
+
 
-        if step % eval_interval == 0:
-            avg_return = compute_avg_return(eval_env, agent.policy, num_eval_episodes)
-            print('step = {0}: Average Return = {1:.2f}'.format(step, avg_return))
-            returns.append(avg_return)
-
-    steps = range(0, num_iterations + 1, eval_interval)
-    plt.plot(steps, returns)
-    plt.ylabel('Average Return')
-    plt.xlabel('Step')
-    plt.show()
-
-    train_checkpointer.save(global_step)
-    print(f"Training ended, checkpoint saved to {checkpoint_dir}")
-
-except KeyboardInterrupt:
-    print("Interrupted")
-    train_checkpointer.save(global_step)
-    print(f"Checkpoint saved to {checkpoint_dir}")
-    pygame.quit()
-    sys.exit(0)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
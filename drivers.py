@@ -0,0 +1,69 @@
+import tensorflow as tf
+from tf_agents.drivers import dynamic_episode_driver
+from tf_agents.drivers import dynamic_step_driver
+from tf_agents.metrics import tf_metrics
+from tf_agents.utils import common
+
+
+def create_collect_driver(environment, policy, observers, num_steps):
+    # Returns run(time_step=None): num_steps batched steps of policy -> env -> observers as one compiled
+    # loop. The driver counts steps summed over the worlds and leaves out restart steps, so the iteration
+    # cap is what keeps every run exactly num_steps batched steps long
+    driver = dynamic_step_driver.DynamicStepDriver(
+        environment, policy, observers=observers, num_steps=num_steps * environment.batch_size)
+    driver_run = common.function(driver.run)
+
+    def run(time_step=None):
+        time_step, _ = driver_run(time_step, maximum_iterations=num_steps)
+        return time_step
+
+    return run
+
+
+def create_return_evaluator(environment, policy, num_episodes):
+    # Returns a function playing num_episodes fresh episodes in one compiled run and averaging their returns
+    average_return = tf_metrics.AverageReturnMetric(batch_size=environment.batch_size, buffer_size=num_episodes)
+    driver = dynamic_episode_driver.DynamicEpisodeDriver(
+        environment, policy, observers=[average_return], num_episodes=num_episodes)
+    driver_run = common.function(driver.run)
+
+    def evaluate():
+        average_return.reset()
+        driver_run(environment.reset())
+        return average_return.result().numpy()
+
+    return evaluate
+
+
+class FirstEpisodeReturns:
+    # Observer adding up each world's reward until that world's first episode ends. Counting whole
+    # episodes instead would favour the worlds whose episodes end early
+    def __init__(self, batch_size):
+        self.returns = tf.Variable(tf.zeros(batch_size))
+        self.finished = tf.Variable(tf.zeros(batch_size, dtype=tf.bool))
+
+    def reset(self):
+        self.returns.assign(tf.zeros_like(self.returns))
+        self.finished.assign(tf.zeros_like(self.finished))
+
+    def __call__(self, trajectory):
+        self.returns.assign_add(tf.where(self.finished, 0.0, trajectory.reward))
+        self.finished.assign(self.finished | trajectory.is_last())
+
+
+def create_batch_evaluator(environment, policy, max_steps, chunk_steps=100):
+    # Returns a function running one episode in every world of a batched environment and averaging
+    # their returns, chunk_steps compiled steps at a time until all of them ended or max_steps passed
+    first_episode_returns = FirstEpisodeReturns(environment.batch_size)
+    run = create_collect_driver(environment, policy, [first_episode_returns], chunk_steps)
+
+    def evaluate():
+        first_episode_returns.reset()
+        time_step = environment.reset()
+        for _ in range(-(-max_steps // chunk_steps)):
+            time_step = run(time_step)
+            if first_episode_returns.finished.numpy().all():
+                break
+        return first_episode_returns.returns.numpy().mean()
+
+    return evaluate
@@ -0,0 +1,295 @@
+import collections
+import json
+import os
+import random
+import struct
+import zlib
+
+import numpy as np
+
+from asteroids import AsteroidsGame
+from asteroids_core import AsteroidsCore
+
+# A file header with the settings replays need, then one chunk per episode. Chunks are only ever appended,
+# a chunk cut short by a crash is ignored when the file is read. On close the recorder writes the offsets of
+# every chunk to a sidecar index, so opening a recording does not have to walk all of its chunk headers
+FILE_MAGIC = b'ASTR'
+CHUNK_MAGIC = b'AEPI'
+VERSION = 2
+FILE_HEADER = struct.Struct('<4sHI')  # magic, version, settings length
+CHUNK_HEADER = struct.Struct('<4sII')  # magic, payload length, crc32 of the payload
+EPISODE_HEADER = struct.Struct('<QdII')  # seed, bullet timer at the start, steps, keyframes
+KEYFRAME_HEADER = struct.Struct('<II')  # step, compressed state length
+INDEX_MAGIC = b'AIDX'
+INDEX_HEADER = struct.Struct('<4sQQ')  # magic, end of the last indexed chunk, number of chunks
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('crc', '<u4')])  # one scan_chunks entry each
+
+Episode = collections.namedtuple('Episode', ['seed', 'bullet_timer', 'actions', 'keyframes'])
+
+
+def pack_actions(actions):
+    # Two actions per byte, low nibble first
+    actions = np.asarray(actions, dtype=np.uint8)
+    if len(actions) % 2:
+        actions = np.append(actions, np.uint8(0))
+    return (actions[0::2] | (actions[1::2] << 4)).tobytes()
+
+
+def unpack_actions(data, num_steps):
+    packed = np.frombuffer(data, dtype=np.uint8)
+    actions = np.empty(2 * len(packed), dtype=np.uint8)
+    actions[0::2] = packed & 0x0F
+    actions[1::2] = packed >> 4
+    return actions[:num_steps]
+
+
+def read_settings(f):
+    header = f.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+        return None
+    magic, version, length = FILE_HEADER.unpack(header)
+    if magic != FILE_MAGIC or version != VERSION:
+        raise ValueError(f"{f.name} is not a version {VERSION} episode recording")
+    return json.loads(f.read(length))
+
+
+def scan_chunks(f):
+    # (payload offset, length, crc32) of every whole chunk after the settings, and where the last one ends.
+    # Only the chunk headers are read, the payloads are skipped over
+    chunks = []
+    file_size = os.fstat(f.fileno()).st_size
+    offset = f.tell()
+    while offset + CHUNK_HEADER.size <= file_size:
+        f.seek(offset)
+        magic, length, crc = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+        if magic != CHUNK_MAGIC or offset + CHUNK_HEADER.size + length > file_size:
+            break
+        chunks.append((offset + CHUNK_HEADER.size, length, crc))
+        offset += CHUNK_HEADER.size + length
+    return chunks, offset
+
+
+def index_path(path):
+    return path + '.index'
+
+
+def read_index(path):
+    # (chunks, end) as written by write_index, or None without a usable index
+    try:
+        with open(index_path(path), 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                return None
+            magic, end, count = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC:
+                return None
+            chunks = np.fromfile(f, dtype=INDEX_DTYPE, count=count)
+    except FileNotFoundError:
+        return None
+    if len(chunks) != count:
+        return None
+    return chunks, end
+
+
+def write_index(path, chunks, end):
+    temporary_path = index_path(path) + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, end, len(chunks)))
+        np.asarray(chunks, dtype=INDEX_DTYPE).tofile(f)
+    os.replace(temporary_path, index_path(path))
+
+
+def load_chunks(f, path):
+    # scan_chunks from the settings on, through the index where there is one. Only chunks appended after the
+    # index was written, e.g. by a recorder that crashed before closing, are scanned
+    chunks, end = np.empty(0, dtype=INDEX_DTYPE), f.tell()
+    index = read_index(path)
+    if index is not None and end <= index[1] <= os.fstat(f.fileno()).st_size:
+        chunks, end = index
+    f.seek(end)
+    tail, end = scan_chunks(f)
+    if tail:
+        chunks = np.concatenate([chunks, np.array(tail, dtype=INDEX_DTYPE)])
+    return chunks, end
+
+
+class EpisodeRecorder:
+    # Records the episodes of an AsteroidsEnvironment as a seed and its actions. Every episode starts from
+    # a fresh seed drawn here, and every keyframe_interval steps the whole game state is stored as well
+    def __init__(self, path, seed=None, keyframe_interval=None):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self._random = random.Random(seed)
+        self._file = None
+        self._game = None
+        self._actions = []
+        self._chunks = []
+
+    def attach(self, asteroids_game, frame_skip):
+        settings = {'dt': asteroids_game.dt, 'frame_skip': frame_skip}
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            f = open(self.path, 'r+b')
+            try:
+                if read_settings(f) != settings:
+                    raise ValueError(f"{self.path} was recorded with different settings")
+                # A chunk left half written by a crash is dropped, new episodes would not be found behind it
+                chunks, end = load_chunks(f, self.path)
+                f.truncate(end)
+                f.seek(end)
+            except BaseException:
+                # Not a recording this game can append to, the file is closed and left as it was
+                f.close()
+                raise
+            self._file = f
+            self._chunks = chunks.tolist()
+        else:
+            # An index left behind by an earlier recording at this path would point into the wrong file
+            if os.path.exists(index_path(self.path)):
+                os.remove(index_path(self.path))
+            self._file = open(self.path, 'wb')
+            encoded = json.dumps(settings).encode()
+            self._file.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, len(encoded)) + encoded)
+            self._chunks = []
+        self._game = asteroids_game
+        # Key presses would steer the ship without being recorded, and replays would drift from the episode
+        asteroids_game.keyboard_control = False
+
+    def begin_episode(self):
+        # Called once the game was reset; an episode cut short by the reset is still kept
+        self.end_episode()
+        self._seed = self._random.getrandbits(63)
+        self._game.random.seed(self._seed)
+        # The reset leaves the shot cooldown running, replays have to start from it too
+        self._bullet_timer = self._game.bullet_timer
+        self._actions = []
+        self._keyframes = []
+
+    def record(self, action):
+        step = len(self._actions)
+        if self.keyframe_interval and step and step % self.keyframe_interval == 0:
+            self._keyframes.append((step, self._game.get_state()))
+        self._actions.append(int(action))
+
+    def end_episode(self):
+        if not self._actions:
+            return
+        parts = [EPISODE_HEADER.pack(self._seed, self._bullet_timer, len(self._actions), len(self._keyframes)),
+                 pack_actions(self._actions)]
+        for step, state in self._keyframes:
+            compressed = zlib.compress(state, 1)
+            parts.append(KEYFRAME_HEADER.pack(step, len(compressed)))
+            parts.append(compressed)
+        payload = b''.join(parts)
+        crc = zlib.crc32(payload)
+        offset = self._file.tell() + CHUNK_HEADER.size
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(payload), crc) + payload)
+        self._file.flush()
+        self._chunks.append((offset, len(payload), crc))
+        self._actions = []
+
+    def close(self):
+        if self._file is not None:
+            self.end_episode()
+            end = self._file.tell()
+            self._file.close()
+            self._file = None
+            write_index(self.path, self._chunks, end)
+
+
+class EpisodeReader:
+    # Random access to the episodes of a recording, and games re-simulated to any step of them
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.settings = read_settings(self._file)
+            if self.settings is None:
+                raise ValueError(f"{path} has no episode recording header")
+            self._chunks, _ = load_chunks(self._file, path)
+        except BaseException:
+            self._file.close()
+            raise
+        self._frame_skip = self.settings['frame_skip']
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def read(self, index):
+        offset, length, crc = self._chunks[index].tolist()
+        self._file.seek(offset)
+        payload = self._file.read(length)
+        if zlib.crc32(payload) != crc:
+            raise ValueError(f"Episode {index} in {self.path} is corrupt")
+
+        seed, bullet_timer, num_steps, num_keyframes = EPISODE_HEADER.unpack_from(payload)
+        position = EPISODE_HEADER.size
+        actions_size = (num_steps + 1) // 2
+        actions = unpack_actions(payload[position:position + actions_size], num_steps)
+        position += actions_size
+        keyframes = []
+        for _ in range(num_keyframes):
+            step, length = KEYFRAME_HEADER.unpack_from(payload, position)
+            position += KEYFRAME_HEADER.size
+            keyframes.append((step, zlib.decompress(payload[position:position + length])))
+            position += length
+        return Episode(seed, bullet_timer, actions, keyframes)
+
+    def num_steps(self, index):
+        self._file.seek(int(self._chunks[index]['offset']))
+        return EPISODE_HEADER.unpack(self._file.read(EPISODE_HEADER.size))[2]
+
+    def _start(self, episode, step):
+        # A headless game and core at the latest keyframe no later than step, or at the start of the episode
+        game = AsteroidsGame(headless=True, dt=self.settings['dt'])
+        core = AsteroidsCore(game, frame_skip=self._frame_skip, metrics_prefix=None)
+        core.reset()
+        keyframes = [(keyframe_step, state) for keyframe_step, state in episode.keyframes if keyframe_step <= step]
+        if keyframes:
+            keyframe_step, state = keyframes[-1]
+            game.set_state(state)
+            return game, core, keyframe_step
+        game.random.seed(episode.seed)
+        game.bullet_timer = int(episode.bullet_timer) if isinstance(game.frames_per_tick, int) else episode.bullet_timer
+        return game, core, 0
+
+    def _advance(self, game, core, action):
+        # The ticks of AsteroidsCore.step without the observation and reward, which replays do not need
+        for _ in range(self._frame_skip):
+            core.apply_action(action)
+            game.render()
+            if game.get_collided():
+                break
+
+    def _check_steps(self, index, episode, *steps):
+        for step in steps:
+            if not 0 <= step <= len(episode.actions):
+                raise ValueError(f"Episode {index} has {len(episode.actions)} steps, step {step} is outside it")
+
+    def replay(self, index, step=None):
+        # The game exactly as it was after step steps of episode index, by default at the end of the episode
+        episode = self.read(index)
+        step = len(episode.actions) if step is None else step
+        self._check_steps(index, episode, step)
+        game, core, first = self._start(episode, step)
+        for action in episode.actions[first:step]:
+            self._advance(game, core, int(action))
+        return game
+
+    def iterate(self, index, start=0, stop=None):
+        # Yields (step, game) after every step from start to stop, one game advanced in place, e.g. for
+        # rendering a stretch of an episode
+        episode = self.read(index)
+        stop = len(episode.actions) if stop is None else stop
+        self._check_steps(index, episode, start, stop)
+        if start > stop:
+            raise ValueError(f"iterate needs start <= stop, got {start} and {stop}")
+        game, core, first = self._start(episode, start)
+        for action in episode.actions[first:start]:
+            self._advance(game, core, int(action))
+        yield start, game
+        for step in range(start, stop):
+            self._advance(game, core, int(episode.actions[step]))
+            yield step + 1, game
+
+    def close(self):
+        self._file.close()
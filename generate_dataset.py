@@ -0,0 +1,304 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from asteroids_core import BatchedAsteroidsCore
+from inference_server import DEFAULT_CHECKPOINT_DIRS
+
+MANIFEST = 'manifest.json'
+# Episode ids are unique across workers, each worker numbers its own below worker << EPISODE_ID_BITS
+EPISODE_ID_BITS = 40
+
+
+def column_layout(observation_shape):
+    # One row per transition: what was observed, the action taken and what followed it
+    return {
+        'observation': [list(observation_shape), 'float32'],
+        'action': [[], 'int32'],
+        'reward': [[], 'float32'],
+        'next_observation': [list(observation_shape), 'float32'],
+        'terminal': [[], 'bool'],
+        'episode': [[], 'int64'],
+        'step': [[], 'int32'],
+    }
+
+
+def random_policy(num_actions, random):
+    # Uniform over the action spec, like the RandomTFPolicy the agents collect their first steps with
+    def choose_actions(observation, first):
+        return random.integers(0, num_actions + 1, size=len(observation)).astype(np.int32)
+    return choose_actions
+
+
+def scripted_policy(num_actions, random, epsilon, aim_tolerance=5):
+    # Turns towards the nearest asteroid and shoots once the ship points at it, with a random action instead
+    # an epsilon fraction of the time
+    def choose_actions(observation, first):
+        angle, dx, dy = observation[:, 2], observation[:, 3], observation[:, 4]
+        # The ship faces (sin angle, -cos angle) on screen
+        bearing = np.degrees(np.arctan2(dx, -dy))
+        offset = (bearing - angle + 180) % 360 - 180
+        actions = np.where(offset > aim_tolerance, 1, np.where(offset < -aim_tolerance, 0, 4)).astype(np.int32)
+        # Without asteroids there is nothing to aim at
+        actions[(dx == 0) & (dy == 0)] = num_actions
+        explore = random.random(len(observation)) < epsilon
+        actions[explore] = random.integers(0, num_actions + 1, size=explore.sum())
+        return actions
+    return choose_actions
+
+
+def checkpoint_policy(agent, checkpoint_dir):
+    # The greedy policy of a dqn_agent or ppo_agent training checkpoint, run on one thread per worker
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from inference_server import batched_actions, load_policy
+    return batched_actions(load_policy(agent, checkpoint_dir))
+
+
+def generate_transitions(core, choose_actions, first_episode):
+    # Yields the transitions of every step of all of core's worlds as a dict of columns, for as long as asked
+    batch_size = core.batch_size
+    episode = first_episode + np.arange(batch_size, dtype=np.int64)
+    next_episode = first_episode + batch_size
+    step = np.zeros(batch_size, dtype=np.int32)
+    observation = core.reset().copy()
+    first = np.ones(batch_size, dtype=bool)
+    while True:
+        action = choose_actions(observation, first)
+        next_observation, reward, restarted, collided = core.step(action)
+        # Worlds that restarted did not act, they only produced the first observation of their next episode
+        acted = ~restarted
+        yield {
+            'observation': observation[acted],
+            'action': action[acted],
+            'reward': reward[acted].astype(np.float32),
+            'next_observation': next_observation[acted],
+            'terminal': collided[acted],
+            'episode': episode[acted],
+            'step': step[acted],
+        }
+        step[acted] += 1
+        if restarted.any():
+            count = int(restarted.sum())
+            episode[restarted] = next_episode + np.arange(count)
+            next_episode += count
+            step[restarted] = 0
+        observation = next_observation.copy()
+        first = restarted
+
+
+class ShardWriter:
+    # Fills one preallocated shard at a time and writes it whole, so memory stays at one shard per worker.
+    # A shard only gets its final name once it is completely written
+    def __init__(self, directory, worker, first_index, shard_size, layout, compress=False):
+        self.directory = directory
+        self.worker = worker
+        self.index = first_index
+        self.shard_size = shard_size
+        self.compress = compress
+        self.columns = {name: np.zeros([shard_size] + shape, dtype=dtype) for name, (shape, dtype) in layout.items()}
+        self.rows = 0
+
+    def write(self, batch, count=None):
+        # Appends the first count rows of batch, returns the manifest entries of the shards it completed
+        count = len(batch['episode']) if count is None else count
+        entries = []
+        written = 0
+        while written < count:
+            rows = min(count - written, self.shard_size - self.rows)
+            for name, column in self.columns.items():
+                column[self.rows:self.rows + rows] = batch[name][written:written + rows]
+            self.rows += rows
+            written += rows
+            if self.rows == self.shard_size:
+                entries.append(self.flush())
+        return entries
+
+    def flush(self):
+        if self.rows == 0:
+            return None
+        name = f"shard-{self.worker:03d}-{self.index:06d}.npz"
+        path = os.path.join(self.directory, name)
+        save = np.savez_compressed if self.compress else np.savez
+        with open(path + '.tmp', 'wb') as f:
+            save(f, **{column_name: column[:self.rows] for column_name, column in self.columns.items()})
+        os.replace(path + '.tmp', path)
+        entry = {'file': name, 'worker': self.worker, 'index': self.index, 'rows': self.rows,
+                 'last_episode': int(self.columns['episode'][:self.rows].max())}
+        self.index += 1
+        self.rows = 0
+        return entry
+
+
+def _worker(worker, settings, options, first_shard, first_episode, quota, messages):
+    # Ctrl+C is handled by the parent, which stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        batch_size = options['envs_per_worker']
+        # A resumed worker starts from fresh seeds, it would otherwise produce the episodes it already wrote
+        seeds = np.random.SeedSequence([options['seed'], worker, first_shard]).generate_state(2)
+        core = BatchedAsteroidsCore(batch_size, seed=int(seeds[0]), frame_skip=settings['frame_skip'],
+                                    metrics_prefix=None, dt=settings['dt'])
+        random = np.random.default_rng(seeds[1])
+        if settings['policy'] == 'random':
+            choose_actions = random_policy(core.num_actions, random)
+        elif settings['policy'] == 'scripted':
+            choose_actions = scripted_policy(core.num_actions, random, settings['epsilon'])
+        else:
+            choose_actions = checkpoint_policy(settings['agent'], settings['checkpoint_dir'])
+
+        writer = ShardWriter(options['directory'], worker, first_shard, settings['shard_size'], settings['columns'],
+                             options['compress'])
+        remaining = quota
+        for batch in generate_transitions(core, choose_actions, first_episode):
+            if remaining <= 0:
+                break
+            count = min(remaining, len(batch['episode']))
+            for entry in writer.write(batch, count):
+                messages.put(('shard', entry))
+            remaining -= count
+        entry = writer.flush()
+        if entry is not None:
+            messages.put(('shard', entry))
+        messages.put(('done', worker))
+    except Exception:
+        messages.put(('error', worker, traceback.format_exc()))
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def read_dataset(directory):
+    # Yields the shards of a dataset in manifest order as dicts of columns, one shard in memory at a time
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise ValueError(f"No dataset manifest in {directory}")
+    for shard in manifest['shards']:
+        with np.load(os.path.join(directory, shard['file'])) as data:
+            yield {name: data[name] for name in data.files}
+
+
+def generate(directory, num_steps, settings, num_workers, envs_per_worker=16, seed=0, compress=False):
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    if manifest is None:
+        manifest = {'settings': settings, 'shards': []}
+        write_manifest(directory, manifest)
+    elif manifest['settings'] != settings:
+        raise ValueError(f"The dataset in {directory} was generated with different settings")
+
+    # A rerun continues after the shards in the manifest; shards a stopped run was still filling are lost
+    stored = sum(shard['rows'] for shard in manifest['shards'])
+    remaining = num_steps - stored
+    if remaining <= 0:
+        print(f"{directory} already holds {stored} steps")
+        return manifest
+
+    options = {'directory': directory, 'envs_per_worker': envs_per_worker, 'seed': seed, 'compress': compress}
+    context = multiprocessing.get_context('spawn')
+    messages = context.Queue()
+    processes = []
+    for worker in range(num_workers):
+        shards = [shard for shard in manifest['shards'] if shard['worker'] == worker]
+        first_shard = max((shard['index'] for shard in shards), default=-1) + 1
+        first_episode = max((shard['last_episode'] + 1 for shard in shards), default=worker << EPISODE_ID_BITS)
+        quota = remaining // num_workers + (worker < remaining % num_workers)
+        processes.append(context.Process(
+            target=_worker, args=(worker, settings, options, first_shard, first_episode, quota, messages),
+            daemon=True))
+    for process in processes:
+        process.start()
+
+    start = time.perf_counter()
+    written = 0
+    running = num_workers
+    try:
+        while running:
+            try:
+                message = messages.get(timeout=1.0)
+            except queue.Empty:
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise RuntimeError("A dataset worker died")
+                continue
+            if message[0] == 'shard':
+                entry = message[1]
+                manifest['shards'].append(entry)
+                write_manifest(directory, manifest)
+                written += entry['rows']
+                rate = written / (time.perf_counter() - start)
+                print(f"{stored + written}/{num_steps} steps, {rate:.0f} steps/s, wrote {entry['file']}")
+            elif message[0] == 'done':
+                running -= 1
+            else:
+                raise RuntimeError(f"Dataset worker {message[1]} failed:\n{message[2]}")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a sharded offline dataset of Asteroids transitions')
+    parser.add_argument('--output-dir', default='dataset')
+    parser.add_argument('--steps', type=int, default=1000000, help='transitions in the whole dataset')
+    parser.add_argument('--policy', choices=('random', 'scripted', 'checkpoint'), default='random')
+    parser.add_argument('--agent', choices=('dqn', 'ppo'), default='dqn', help='agent of a checkpoint policy')
+    parser.add_argument('--checkpoint-dir', help='training checkpoint, by default the agent script\'s own')
+    parser.add_argument('--epsilon', type=float, default=0.05, help='random action rate of the scripted policy')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--envs-per-worker', type=int, default=16)
+    parser.add_argument('--shard-size', type=int, default=100000, help='transitions per shard')
+    parser.add_argument('--frame-skip', type=int, default=1)
+    parser.add_argument('--dt', type=float, help='simulated seconds per game tick')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compress', action='store_true', help='deflate the shards')
+    args = parser.parse_args(argv)
+
+    # Everything that decides what the data looks like; a resumed dataset has to keep all of it
+    settings = {
+        'policy': args.policy,
+        'agent': args.agent if args.policy == 'checkpoint' else None,
+        'checkpoint_dir': (args.checkpoint_dir or DEFAULT_CHECKPOINT_DIRS[args.agent])
+        if args.policy == 'checkpoint' else None,
+        'epsilon': args.epsilon if args.policy == 'scripted' else None,
+        'frame_skip': args.frame_skip,
+        'dt': args.dt,
+        'shard_size': args.shard_size,
+        'columns': column_layout(BatchedAsteroidsCore(1, metrics_prefix=None).observation_shape),
+    }
+    try:
+        manifest = generate(args.output_dir, args.steps, settings, args.workers, args.envs_per_worker, args.seed,
+                            args.compress)
+    except KeyboardInterrupt:
+        print(f"Interrupted, run again to continue {args.output_dir}")
+        return 1
+    stored = sum(shard['rows'] for shard in manifest['shards'])
+    print(f"{args.output_dir} holds {stored} steps in {len(manifest['shards'])} shards")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
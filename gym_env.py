@@ -0,0 +1,39 @@
+import numpy as np
+
+
+class AsteroidsGymEnvironment:
+    # Gymnasium-style reset/step over an AsteroidsCore; gym is only imported for the spaces
+    metadata = {'render_modes': []}
+
+    def __init__(self, core):
+        self.core = core
+        self._action_space = None
+        self._observation_space = None
+
+    @property
+    def action_space(self):
+        if self._action_space is None:
+            from gym import spaces
+            self._action_space = spaces.Discrete(self.core.num_actions)
+        return self._action_space
+
+    @property
+    def observation_space(self):
+        if self._observation_space is None:
+            from gym import spaces
+            low, high = self.core.observation_bounds or (-np.inf, np.inf)
+            self._observation_space = spaces.Box(low=low, high=high, shape=self.core.observation_shape,
+                                                 dtype=self.core.observation_dtype)
+        return self._observation_space
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            self.core.seed(seed)
+        return self.core.reset().copy(), {}
+
+    def step(self, action):
+        observation, reward, done = self.core.step(action)
+        return observation.copy(), float(reward), done, False, {'score': self.core.get_score()}
+
+    def close(self):
+        pass
@@ -0,0 +1,22 @@
+import math
+
+import numpy as np
+
+# Unit vectors for every whole degree; angles in the game only ever land on integers
+COS_TABLE = [math.cos(math.radians(degree)) for degree in range(360)]
+SIN_TABLE = [math.sin(math.radians(degree)) for degree in range(360)]
+
+COS_ARRAY = np.array(COS_TABLE)
+SIN_ARRAY = np.array(SIN_TABLE)
+
+
+def heading_velocity(heading, speed):
+    # Screen y grows downwards, so a heading of 90 degrees moves up
+    degree = int(heading) % 360
+    return speed * COS_TABLE[degree], -speed * SIN_TABLE[degree]
+
+
+def rotate_points(points, angle):
+    degree = int(angle) % 360
+    cos, sin = COS_TABLE[degree], SIN_TABLE[degree]
+    return tuple((x * cos - y * sin, x * sin + y * cos) for x, y in points)
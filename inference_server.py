@@ -0,0 +1,291 @@
+import argparse
+import collections
+import os
+import queue
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from metrics import metrics
+
+DEFAULT_CHECKPOINT_DIRS = {
+    'dqn': os.path.join('saved_policy', 'checkpoint'),
+    'ppo': os.path.join('saved_policy_ppo', 'checkpoint'),
+}
+
+
+def load_policy(agent='dqn', checkpoint_dir=None):
+    # The greedy policy of a dqn_agent or ppo_agent training checkpoint
+    from tf_agents.environments import tf_py_environment
+    from tf_agents.utils import common
+
+    from asteroids_env import BatchedAsteroidsEnvironment
+    if agent == 'dqn':
+        from dqn_agent import create_eval_policy
+    else:
+        from ppo_agent import create_eval_policy
+
+    checkpoint_dir = checkpoint_dir or DEFAULT_CHECKPOINT_DIRS[agent]
+    # The environment only supplies the specs, which do not depend on its batch size
+    policy = create_eval_policy(tf_py_environment.TFPyEnvironment(BatchedAsteroidsEnvironment(1, metrics_prefix=None)))
+    checkpointer = common.Checkpointer(ckpt_dir=checkpoint_dir, policy=policy)
+    if not checkpointer.checkpoint_exists:
+        raise ValueError(f"No checkpoint in {checkpoint_dir}")
+    # Only the policy is restored, the rest of the training checkpoint is left out on purpose
+    checkpointer.initialize_or_restore().expect_partial()
+    return policy
+
+
+def batched_actions(policy):
+    # choose_actions(observation, first) over a batch of observations, compiled once per batch size
+    import tensorflow as tf
+    from tf_agents.trajectories import time_step as ts
+    from tf_agents.utils import common
+
+    action = common.function(policy.action)
+
+    def choose_actions(observation, first):
+        batch_size = len(observation)
+        step_type = np.where(first, ts.StepType.FIRST, ts.StepType.MID).astype(np.int32)
+        time_step = ts.TimeStep(tf.constant(step_type), tf.zeros(batch_size, dtype=tf.float32),
+                                tf.ones(batch_size, dtype=tf.float32), tf.constant(observation))
+        return action(time_step).action.numpy().astype(np.int32)
+    return choose_actions
+
+
+class InferenceRequest:
+    def __init__(self, observation, first):
+        self.observation = observation
+        self.first = first
+        self.submitted = time.perf_counter()
+        self.action = None
+        self.error = None
+        self._done = threading.Event()
+
+    def set_result(self, action=None, error=None):
+        self.action = action
+        self.error = error
+        self._done.set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("No action from the inference server")
+        if self.error is not None:
+            raise self.error
+        return self.action
+
+
+class InferenceServer:
+    # Collects the observations of many callers into one policy call per batch, on a thread of its own.
+    # A batch goes out once it holds max_batch_size requests, once its oldest request has waited max_latency
+    # seconds, or as soon as every connected session is waiting in it. Batches are padded to powers of two,
+    # so the compiled policy only ever sees a few batch sizes
+    def __init__(self, choose_actions, observation_shape, observation_dtype=np.float32, max_batch_size=64,
+                 max_latency=0.002, metrics_prefix='inference/', stats_size=10000):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._choose_actions = choose_actions
+        self._observation_shape = tuple(observation_shape)
+        self._observation_dtype = np.dtype(observation_dtype)
+        self._metrics_prefix = metrics_prefix
+        self._requests = queue.Queue()
+        self._sessions = 0
+        self._lock = threading.Lock()
+        self._batch_sizes = collections.deque(maxlen=stats_size)
+        self._latencies = collections.deque(maxlen=stats_size)
+        self._listener = None
+        self._thread = threading.Thread(target=self._run, name='inference', daemon=True)
+        self._thread.start()
+
+    def warmup(self):
+        # Compiles the policy for every padded batch size, so no client waits on tracing later
+        size = 1
+        while size < 2 * self.max_batch_size:
+            self._choose_actions(np.zeros((size,) + self._observation_shape, dtype=self._observation_dtype),
+                                 np.zeros(size, dtype=bool))
+            size *= 2
+
+    def submit(self, observation, first=False):
+        # Returns at once, the request's result() waits for the action
+        request = InferenceRequest(observation, first)
+        self._requests.put(request)
+        return request
+
+    def action(self, observation, first=False):
+        return self.submit(observation, first).result()
+
+    def connect(self):
+        # A session is a caller with at most one request in flight, e.g. one game loop. Knowing how many there
+        # are lets a batch go out without waiting out max_latency once all of them are in it
+        return InferenceSession(self)
+
+    def _next_batch(self):
+        request = self._requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = request.submitted + self.max_latency
+        while len(batch) < self.max_batch_size and not (self._sessions and len(batch) >= self._sessions):
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._requests.get(timeout=remaining) if remaining > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Serve what has been collected, then stop
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            size = len(batch)
+            padded = 1 << (size - 1).bit_length()
+            observations = np.zeros((padded,) + self._observation_shape, dtype=self._observation_dtype)
+            first = np.zeros(padded, dtype=bool)
+            for index, request in enumerate(batch):
+                observations[index] = request.observation
+                first[index] = request.first
+            try:
+                actions = self._choose_actions(observations, first)
+            except Exception as error:
+                for request in batch:
+                    request.set_result(error=error)
+                continue
+
+            now = time.perf_counter()
+            latencies = [1000 * (now - request.submitted) for request in batch]
+            for request, action in zip(batch, actions[:size].tolist()):
+                request.set_result(action)
+            with self._lock:
+                self._batch_sizes.append(size)
+                self._latencies.extend(latencies)
+            if self._metrics_prefix is not None:
+                metrics.record(self._metrics_prefix + 'batch_size', size)
+                metrics.record_many(self._metrics_prefix + 'latency_ms', latencies)
+
+    def stats(self):
+        # Over the latest stats_size batches and requests
+        with self._lock:
+            batch_sizes = np.array(self._batch_sizes)
+            latencies = np.array(self._latencies)
+        if len(batch_sizes) == 0:
+            return {'batches': 0, 'requests': 0}
+        return {
+            'batches': len(batch_sizes),
+            'requests': len(latencies),
+            'mean_batch_size': float(batch_sizes.mean()),
+            'max_batch_size': int(batch_sizes.max()),
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
+        }
+
+    def serve(self, path):
+        # Also takes requests from other processes through a Unix socket at path, see InferenceClient
+        if os.path.exists(path):
+            os.unlink(path)
+        self._listener = Listener(path, family='AF_UNIX')
+        threading.Thread(target=self._accept, args=(self._listener,), name='inference-accept', daemon=True).start()
+
+    def _accept(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    def _handle(self, connection):
+        session = self.connect()
+        try:
+            while True:
+                try:
+                    observation, first = connection.recv()
+                except (EOFError, OSError):
+                    break
+                connection.send(session.action(observation, first))
+        finally:
+            session.close()
+            connection.close()
+
+    def close(self):
+        if self._listener is not None:
+            address = self._listener.address
+            self._listener.close()
+            self._listener = None
+            if os.path.exists(address):
+                os.unlink(address)
+        self._requests.put(None)
+        self._thread.join()
+
+
+class InferenceSession:
+    def __init__(self, server):
+        self._server = server
+        with server._lock:
+            server._sessions += 1
+        self._open = True
+
+    def action(self, observation, first=False):
+        return self._server.action(observation, first)
+
+    def close(self):
+        if self._open:
+            with self._server._lock:
+                self._server._sessions -= 1
+            self._open = False
+
+
+class InferenceClient:
+    # An InferenceServer.serve socket seen from another process
+    def __init__(self, path):
+        self._connection = Client(path, family='AF_UNIX')
+
+    def action(self, observation, first=False):
+        self._connection.send((np.asarray(observation, dtype=np.float32), bool(first)))
+        return self._connection.recv()
+
+    def close(self):
+        self._connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve batched actions of a trained Asteroids policy')
+    parser.add_argument('--agent', choices=('dqn', 'ppo'), default='dqn')
+    parser.add_argument('--checkpoint-dir', help='training checkpoint, by default the agent script\'s own')
+    parser.add_argument('--socket', default='asteroids_policy.sock')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=2.0)
+    parser.add_argument('--report-seconds', type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    from asteroids_core import BatchedAsteroidsCore
+    observation_shape = BatchedAsteroidsCore(1, metrics_prefix=None).observation_shape
+    server = InferenceServer(batched_actions(load_policy(args.agent, args.checkpoint_dir)), observation_shape,
+                             max_batch_size=args.max_batch_size, max_latency=args.max_latency_ms / 1000,
+                             metrics_prefix=None)
+    server.warmup()
+    server.serve(args.socket)
+    print(f"Serving {args.agent} actions on {args.socket}")
+    try:
+        while True:
+            time.sleep(args.report_seconds)
+            stats = server.stats()
+            if stats['batches']:
+                print(f"{stats['requests']} requests in {stats['batches']} batches, mean batch size "
+                      f"{stats['mean_batch_size']:.1f}, latency p50 {stats['latency_p50_ms']:.2f} ms "
+                      f"p99 {stats['latency_p99_ms']:.2f} ms")
+    except KeyboardInterrupt:
+        server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+import csv
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+class MetricSeries:
+    # The latest capacity records of one metric; written counts how many of all records have been flushed
+    def __init__(self, capacity):
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.steps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+        self.written = 0
+        self.reported = 0
+
+    def append(self, now, step, values):
+        capacity = len(self.values)
+        slots = np.arange(self.count, self.count + len(values)) % capacity
+        self.times[slots] = now
+        self.steps[slots] = step
+        self.values[slots] = values
+        self.count += len(values)
+
+    def since(self, first):
+        # Records first.. that are still in the ring, oldest first
+        first = max(first, self.count - len(self.values))
+        slots = np.arange(first, self.count) % len(self.values)
+        return self.times[slots], self.steps[slots], self.values[slots]
+
+
+class MetricsSink:
+    # Recording only writes into ring buffers, so it is cheap enough for the collection loop. A background
+    # thread started with start() writes the new records out every flush_seconds.
+    # verbosity 0 keeps the console quiet, 1 prints a summary line per flush, 2 also prints every record
+    def __init__(self, capacity=4096, verbosity=1):
+        self.capacity = capacity
+        self.verbosity = verbosity
+        self.step = 0
+        self._series = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._writers = []
+
+    def set_step(self, step):
+        # Records without an explicit step are filed under the latest training step
+        self.step = int(step)
+
+    def record(self, name, value, step=None):
+        self.record_many(name, (value,), step)
+
+    def record_many(self, name, values, step=None):
+        if len(values) == 0:
+            return
+        step = self.step if step is None else int(step)
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = MetricSeries(self.capacity)
+            series.append(time.time(), step, values)
+        if self.verbosity >= 2:
+            for value in values:
+                print(f"step {step}: {name} = {value:.4g}")
+
+    def latest(self, name, count=None):
+        # The last count values of name still in its ring, oldest first
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                return np.zeros(0)
+            first = 0 if count is None else series.count - count
+            return series.since(first)[2]
+
+    def start(self, directory=None, formats=('csv',), flush_seconds=10.0, verbosity=None):
+        # formats picks any of 'csv', 'jsonl' and 'tensorboard', all of them written to directory
+        if verbosity is not None:
+            self.verbosity = verbosity
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for output_format in formats:
+                if output_format == 'csv':
+                    self._writers.append(CsvWriter(os.path.join(directory, 'metrics.csv')))
+                elif output_format == 'jsonl':
+                    self._writers.append(JsonlWriter(os.path.join(directory, 'metrics.jsonl')))
+                elif output_format == 'tensorboard':
+                    self._writers.append(TensorBoardWriter(directory))
+                else:
+                    raise ValueError(f"Unknown metrics format {output_format}")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(flush_seconds,), name='metrics', daemon=True)
+        self._thread.start()
+
+    def _run(self, flush_seconds):
+        while not self._stop.wait(flush_seconds):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            new_records = {}
+            for name, series in self._series.items():
+                if series.count > series.written:
+                    new_records[name] = series.since(series.written)
+                    series.written = series.count
+            new_summary = {}
+            for name, series in self._series.items():
+                if series.count > series.reported:
+                    new_summary[name] = series.since(series.reported)[2]
+                    series.reported = series.count
+
+        # Files and the console are written outside the lock, recording never waits on them
+        for writer in self._writers:
+            writer.write(new_records)
+        if self.verbosity >= 1 and new_summary:
+            parts = [f"{name} {values.mean():.4g}" + (f" (n={len(values)})" if len(values) > 1 else "")
+                     for name, values in sorted(new_summary.items())]
+            print(f"step {self.step}: " + ", ".join(parts), file=sys.stdout, flush=True)
+
+    def close(self):
+        # Stops the flush thread, writes whatever is left and closes the files
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        for writer in self._writers:
+            writer.close()
+        self._writers = []
+
+
+class CsvWriter:
+    def __init__(self, path):
+        new_file = not os.path.exists(path)
+        self._file = open(path, 'a', newline='')
+        self._csv = csv.writer(self._file)
+        if new_file:
+            self._csv.writerow(['time', 'step', 'name', 'value'])
+
+    def write(self, records):
+        for name, (times, steps, values) in records.items():
+            self._csv.writerows(zip(times.tolist(), steps.tolist(), [name] * len(values), values.tolist()))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self._file = open(path, 'a')
+
+    def write(self, records):
+        for name, (times, steps, values) in records.items():
+            for record_time, step, value in zip(times.tolist(), steps.tolist(), values.tolist()):
+                self._file.write(json.dumps({'time': record_time, 'step': step, 'name': name, 'value': value}) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TensorBoardWriter:
+    def __init__(self, directory):
+        import tensorflow as tf
+        self._tf = tf
+        self._writer = tf.summary.create_file_writer(directory)
+
+    def write(self, records):
+        with self._writer.as_default():
+            for name, (_, steps, values) in records.items():
+                for step, value in zip(steps.tolist(), values.tolist()):
+                    self._tf.summary.scalar(name, value, step=step)
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+
+# Shared by the game, the environments and the training scripts; ASTEROIDS_VERBOSITY sets the console level
+metrics = MetricsSink(verbosity=int(os.environ.get('ASTEROIDS_VERBOSITY', '1')))
@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+from tf_agents.replay_buffers.tf_uniform_replay_buffer import BufferInfo
+
+
+class MemmapReplayBuffer:
+    # A ring of max_length steps per environment, kept in preallocated .npy files in directory.
+    # Opening the same directory again continues from the last checkpoint()
+    info_type = BufferInfo
+    info_dtypes = (tf.int64, tf.float32)
+
+    def __init__(self, data_spec, batch_size, max_length, directory, seed=None):
+        self.data_spec = data_spec
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.directory = directory
+        self._specs = tf.nest.flatten(data_spec)
+        self._random = np.random.default_rng(seed)
+        # The dataset samples from several threads while the driver adds, and the generator is not thread-safe
+        self._lock = threading.Lock()
+
+        self._layout = {
+            'batch_size': batch_size,
+            'max_length': max_length,
+            'columns': [[spec.shape.as_list(), spec.dtype.name] for spec in self._specs],
+        }
+        os.makedirs(directory, exist_ok=True)
+        metadata = self._read_metadata()
+        if metadata is not None and metadata['layout'] != self._layout:
+            raise ValueError(f"The replay buffer in {directory} was created with a different layout")
+
+        mode = 'w+' if metadata is None else 'r+'
+        self._columns = [
+            np.lib.format.open_memmap(os.path.join(directory, f"column_{index}.npy"), mode=mode,
+                                      dtype=spec.dtype.as_numpy_dtype,
+                                      shape=(max_length, batch_size) + tuple(spec.shape.as_list()))
+            for index, spec in enumerate(self._specs)]
+        self._cursor = 0 if metadata is None else metadata['cursor']
+        if metadata is None:
+            self.checkpoint()
+
+    def _metadata_path(self):
+        return os.path.join(self.directory, 'metadata.json')
+
+    def _read_metadata(self):
+        if not os.path.exists(self._metadata_path()):
+            return None
+        with open(self._metadata_path()) as f:
+            return json.load(f)
+
+    def checkpoint(self):
+        # The columns are already on disk, so only dirty pages get flushed and a few bytes of metadata written
+        for column in self._columns:
+            column.flush()
+        temporary_path = self._metadata_path() + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({'cursor': self._cursor, 'layout': self._layout}, f)
+        os.replace(temporary_path, self._metadata_path())
+
+    def num_frames(self):
+        return min(self._cursor, self.max_length) * self.batch_size
+
+    def add_batch(self, items):
+        with self._lock:
+            self._write_row(items)
+
+    def _write_row(self, items):
+        # Callers hold the lock
+        row = self._cursor % self.max_length
+        for column, value in zip(self._columns, tf.nest.flatten(items)):
+            column[row] = value
+        self._cursor += 1
+
+    def graph_add_batch(self, items):
+        # add_batch as an observer for compiled drivers, where items are symbolic tensors
+        tf.numpy_function(lambda *values: self.add_batch(tf.nest.pack_sequence_as(self.data_spec, values)),
+                          tf.nest.flatten(items), [])
+
+    def sample(self, sample_batch_size, num_steps):
+        # Windows of num_steps consecutive steps from one environment each, like TFUniformReplayBuffer
+        # The lock is held until the rows are gathered, so no window is overwritten halfway through
+        with self._lock:
+            cursor = self._cursor
+            stored = min(cursor, self.max_length)
+            if stored < num_steps:
+                raise ValueError(f"Need {num_steps} stored steps to sample from, the buffer has {stored}")
+            starts = self._random.integers(cursor - stored, cursor - num_steps + 1, size=sample_batch_size)
+            environments = self._random.integers(0, self.batch_size, size=sample_batch_size)
+
+            rows = (starts[:, None] + np.arange(num_steps)) % self.max_length
+            items = [column[rows, environments[:, None]] for column in self._columns]
+        ids = starts * self.batch_size + environments
+        probabilities = np.full(sample_batch_size, 1.0 / (stored * self.batch_size), dtype=np.float32)
+        return items, self.info_type(ids, probabilities)
+
+    def as_dataset(self, sample_batch_size, num_steps, num_parallel_calls=None):
+        output_types = [spec.dtype for spec in self._specs] + list(self.info_dtypes)
+
+        def sample_flat():
+            items, info = self.sample(sample_batch_size, num_steps)
+            return items + list(info)
+
+        def sample_batch(_):
+            values = tf.numpy_function(sample_flat, [], output_types)
+            items, info = values[:len(self._specs)], values[len(self._specs):]
+            for value, spec in zip(items, self._specs):
+                value.set_shape([sample_batch_size, num_steps] + spec.shape.as_list())
+            for value in info:
+                value.set_shape([sample_batch_size])
+            return tf.nest.pack_sequence_as(self.data_spec, items), self.info_type(*info)
+
+        return tf.data.Dataset.range(1).repeat().map(sample_batch, num_parallel_calls=num_parallel_calls)
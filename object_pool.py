@@ -0,0 +1,93 @@
+class ObjectPool:
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.size = 0
+        self.x = [0.0] * capacity
+        self.y = [0.0] * capacity
+        self.heading = [0.0] * capacity
+        self.vx = [0.0] * capacity
+        self.vy = [0.0] * capacity
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('pool index out of range')
+        return self.x[index], self.y[index], self.heading[index]
+
+    def __iter__(self):
+        size = self.size
+        return zip(self.x[:size], self.y[:size], self.heading[:size])
+
+    def append(self, x, y, heading, vx=0.0, vy=0.0):
+        if self.size == self.capacity:
+            self._grow()
+        self.x[self.size] = x
+        self.y[self.size] = y
+        self.heading[self.size] = heading
+        self.vx[self.size] = vx
+        self.vy[self.size] = vy
+        self.size += 1
+
+    def _grow(self):
+        for column in (self.x, self.y, self.heading, self.vx, self.vy):
+            column.extend([0.0] * self.capacity)
+        self.capacity *= 2
+
+    def remove(self, index):
+        # Swap-remove: the last live object takes over the freed slot
+        last = self.size - 1
+        self.x[index] = self.x[last]
+        self.y[index] = self.y[last]
+        self.heading[index] = self.heading[last]
+        self.vx[index] = self.vx[last]
+        self.vy[index] = self.vy[last]
+        self.size = last
+
+    def remove_many(self, indices):
+        # Highest index first, so every object swapped down is one that survives
+        for index in sorted(indices, reverse=True):
+            self.remove(index)
+
+    def clear(self):
+        self.size = 0
+
+    def get_state(self):
+        # Live objects only, one column after another
+        size = self.size
+        return self.x[:size] + self.y[:size] + self.heading[:size] + self.vx[:size] + self.vy[:size]
+
+    def snapshot(self):
+        return PoolSnapshot(self)
+
+    def set_state(self, values, size):
+        while self.capacity < size:
+            self._grow()
+        for i, column in enumerate((self.x, self.y, self.heading, self.vx, self.vy)):
+            column[:size] = values[i * size:(i + 1) * size]
+        self.size = size
+
+
+class PoolSnapshot:
+    # The live objects of a pool copied into tuples, so callers outside the game can read them but never
+    # change the game's pool. Reads like the pool itself: columns, size and a sequence of (x, y, heading)
+    def __init__(self, pool):
+        size = pool.size
+        self.size = size
+        self.x = tuple(pool.x[:size])
+        self.y = tuple(pool.y[:size])
+        self.heading = tuple(pool.heading[:size])
+        self.vx = tuple(pool.vx[:size])
+        self.vy = tuple(pool.vy[:size])
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.x[index], self.y[index], self.heading[index]
+
+    def __iter__(self):
+        return zip(self.x, self.y, self.heading)
@@ -0,0 +1,187 @@
+import os
+import subprocess
+import sys
+import threading
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from tf_agents.environments import py_environment
+from tf_agents.trajectories import time_step as ts
+
+from asteroids_env import create_specs
+from metrics import metrics
+from parallel_worker import create_asteroids_core, shared_arrays, shared_layout
+
+worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parallel_worker.py')
+
+
+def watch_workers(processes, address, authkey, stop, poll_interval=0.5):
+    # Listener.accept has no timeout. If a worker exits before all of them connected, this connects in its
+    # place and says so, so the accept loop raises instead of waiting forever
+    while not stop.wait(poll_interval):
+        for index, process in enumerate(processes):
+            if process.poll() is not None:
+                try:
+                    with Client(address, authkey=authkey) as connection:
+                        connection.send(('exited', index))
+                except (OSError, EOFError):
+                    # The accept loop was already done
+                    pass
+                return
+
+
+class ProcessPoolEnvironment(py_environment.PyEnvironment):
+    # Each worker process steps one core built by core_constructor(**core_options), a module-level function the
+    # workers can import
+    def __init__(self, num_envs, core_constructor=create_asteroids_core, metrics_prefix='episode/', core_options=None):
+        super().__init__()
+        self._num_envs = num_envs
+        self._metrics_prefix = metrics_prefix
+        self._episode_return = np.zeros(num_envs, dtype=np.float64)
+        self._episode_length = np.zeros(num_envs, dtype=np.int64)
+
+        # Workers run parallel_worker.py as a plain script: unlike multiprocessing's spawn they never
+        # re-import the training script, so they start without TensorFlow
+        authkey = os.urandom(32)
+        self._connections = []
+        self._processes = []
+        self._memory = None
+        try:
+            with Listener(authkey=authkey) as listener:
+                for index in range(num_envs):
+                    self._processes.append(subprocess.Popen(
+                        [sys.executable, worker_script, str(listener.address), authkey.hex(), str(index)]))
+                self._accept_workers(listener, authkey)
+
+            for connection in self._connections:
+                connection.send(sys.path)
+                connection.send((core_constructor, core_options or {}, num_envs))
+            specs = [self._receive_spec(index) for index in range(num_envs)]
+            self._observation_spec, self._action_spec = create_specs(*specs[0])
+
+            layout, size = shared_layout(num_envs, self._observation_spec.shape, self._observation_spec.dtype)
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+            self._arrays = shared_arrays(self._memory.buf, layout)
+            for connection in self._connections:
+                connection.send(self._memory.name)
+        except BaseException:
+            self._abort_startup()
+            raise
+
+        self._waiting = False
+        self._closed = False
+
+    def _accept_workers(self, listener, authkey):
+        stop = threading.Event()
+        watcher = threading.Thread(target=watch_workers, args=(self._processes, listener.address, authkey, stop),
+                                   daemon=True)
+        watcher.start()
+        try:
+            connections = {}
+            while len(connections) < self._num_envs:
+                connection = listener.accept()
+                kind, index = connection.recv()
+                if kind == 'exited':
+                    connection.close()
+                    raise RuntimeError(f"Environment worker {index} exited with code "
+                                       f"{self._processes[index].returncode} before connecting")
+                connections[index] = connection
+                # Kept as they arrive, so a failed startup still closes them all
+                self._connections.append(connection)
+        finally:
+            # Not joined: a watcher still connecting finds the listener closed once the caller leaves it
+            stop.set()
+        self._connections = [connections[index] for index in range(self._num_envs)]
+
+    def _receive_spec(self, index):
+        try:
+            kind, value = self._connections[index].recv()
+        except EOFError:
+            raise RuntimeError(f"Environment worker {index} exited with code {self._processes[index].wait()} "
+                               f"while starting") from None
+        if kind == 'error':
+            raise RuntimeError(f"Environment worker {index} could not build its core:\n{value}")
+        return value
+
+    def _abort_startup(self):
+        for process in self._processes:
+            process.kill()
+        for process in self._processes:
+            process.wait()
+        for connection in self._connections:
+            connection.close()
+        if self._memory is not None:
+            self._arrays = None
+            self._memory.close()
+            self._memory.unlink()
+
+    @property
+    def batched(self):
+        return True
+
+    @property
+    def batch_size(self):
+        return self._num_envs
+
+    def action_spec(self):
+        return self._action_spec
+
+    def observation_spec(self):
+        return self._observation_spec
+
+    def _send(self, command):
+        for connection in self._connections:
+            connection.send(command)
+        self._waiting = True
+
+    def _collect(self):
+        for connection in self._connections:
+            connection.recv()
+        self._waiting = False
+        # Copy out of shared memory, the workers overwrite it on the next step
+        time_step = ts.TimeStep(self._arrays['step_type'].copy(), self._arrays['reward'].copy(),
+                                self._arrays['discount'].copy(), self._arrays['observation'].copy())
+        self._record_episodes(time_step)
+        return time_step
+
+    def _record_episodes(self, time_step):
+        first = time_step.step_type == ts.StepType.FIRST
+        self._episode_return[first] = 0
+        self._episode_length[first] = 0
+        self._episode_return[~first] += time_step.reward[~first]
+        self._episode_length[~first] += 1
+        last = time_step.step_type == ts.StepType.LAST
+        if last.any() and self._metrics_prefix is not None:
+            metrics.record_many(self._metrics_prefix + 'return', self._episode_return[last])
+            metrics.record_many(self._metrics_prefix + 'length', self._episode_length[last])
+
+    def _reset(self):
+        self._send('reset')
+        return self._collect()
+
+    def _step(self, action):
+        self.step_async(action)
+        return self._collect()
+
+    def step_async(self, action):
+        # Workers run while the caller does something else, e.g. the next policy call
+        self._arrays['action'][:] = np.asarray(action).reshape(self._num_envs)
+        self._send('step')
+
+    def step_wait(self):
+        self._current_time_step = self._collect()
+        return self._current_time_step
+
+    def close(self):
+        if self._closed:
+            return
+        if self._waiting:
+            self._collect()
+        self._send('close')
+        for process in self._processes:
+            process.wait()
+        self._arrays = None
+        self._memory.close()
+        self._memory.unlink()
+        self._closed = True
@@ -0,0 +1,93 @@
+import signal
+import sys
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client
+
+import numpy as np
+
+from asteroids_core import core_spec
+
+# tf_agents StepType values, written by the workers without importing TensorFlow
+FIRST, MID, LAST = 0, 1, 2
+
+
+def create_asteroids_core(dt=None, **core_options):
+    from asteroids import AsteroidsGame
+    from asteroids_core import AsteroidsCore
+
+    # Episodes are recorded by the parent, which sees every step's reward and step type
+    return AsteroidsCore(AsteroidsGame(headless=True, dt=dt), metrics_prefix=None, **core_options)
+
+
+def shared_layout(num_envs, observation_shape, observation_dtype):
+    # Carve the per-env step results and actions out of a single shared block
+    fields = [
+        ('observation', (num_envs,) + tuple(observation_shape), np.dtype(observation_dtype)),
+        ('reward', (num_envs,), np.dtype(np.float32)),
+        ('discount', (num_envs,), np.dtype(np.float32)),
+        ('step_type', (num_envs,), np.dtype(np.int32)),
+        ('action', (num_envs,), np.dtype(np.int64)),
+    ]
+    layout = []
+    offset = 0
+    for name, shape, dtype in fields:
+        offset = -(-offset // dtype.alignment) * dtype.alignment
+        layout.append((name, shape, dtype, offset))
+        offset += int(np.prod(shape)) * dtype.itemsize
+    return layout, offset
+
+
+def shared_arrays(buffer, layout):
+    return {name: np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            for name, shape, dtype, offset in layout}
+
+
+def worker(connection, index):
+    # Ctrl+C is handled by the parent, which shuts the workers down through close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    connection.send(('ready', index))
+    try:
+        sys.path[:] = connection.recv()
+        core_constructor, core_options, num_envs = connection.recv()
+        core = core_constructor(**core_options)
+    except Exception:
+        # The parent raises with this traceback rather than a bare EOFError
+        connection.send(('error', traceback.format_exc()))
+        return
+    connection.send(('spec', core_spec(core)))
+
+    memory = shared_memory.SharedMemory(name=connection.recv())
+    # The parent owns the block; this process's own resource tracker would unlink it on exit
+    resource_tracker.unregister(memory._name, 'shared_memory')
+    layout, _ = shared_layout(num_envs, core.observation_shape, core.observation_dtype)
+    arrays = shared_arrays(memory.buf, layout)
+    episode_ended = True
+    try:
+        while True:
+            try:
+                command = connection.recv()
+            except EOFError:
+                break
+            if command == 'step' and not episode_ended:
+                observation, reward, episode_ended = core.step(int(arrays['action'][index]))
+                step_type = LAST if episode_ended else MID
+            elif command in ('step', 'reset'):
+                observation, reward, episode_ended = core.reset(), 0.0, False
+                step_type = FIRST
+            else:
+                break
+
+            arrays['observation'][index] = observation
+            arrays['reward'][index] = reward
+            arrays['discount'][index] = 0.0 if episode_ended else 1.0
+            arrays['step_type'][index] = step_type
+            connection.send(True)
+    finally:
+        del arrays
+        memory.close()
+
+
+if __name__ == '__main__':
+    address, authkey, index = sys.argv[1], bytes.fromhex(sys.argv[2]), int(sys.argv[3])
+    worker(Client(address, authkey=authkey), index)
@@ -0,0 +1,73 @@
+import numpy as np
+import pygame
+
+
+class PixelObserver:
+    # Grayscale levels the objects are drawn with on the 8-bit frame
+    PLAYER = 255
+    BULLET = 170
+    ASTEROID = 100
+
+    def __init__(self, asteroids_game, frame_size=(84, 84), frame_stack=4):
+        self._asteroids_game = asteroids_game
+        self.frame_width, self.frame_height = frame_size
+        self.frame_stack = frame_stack
+        self.scale_x = self.frame_width / asteroids_game.WIDTH
+        self.scale_y = self.frame_height / asteroids_game.HEIGHT
+
+        # The game is drawn straight at frame size, never rendered at 800x600 and downscaled
+        self.surface = pygame.Surface(frame_size, depth=8)
+        self.surface.set_palette([(level, level, level) for level in range(256)])
+        # A live (height, width) view of the surface pixels, no copy per frame
+        self.pixels = pygame.surfarray.pixels2d(self.surface).T
+
+        # Every frame is written twice, so the latest frame_stack frames are always one contiguous slice
+        self._frames = np.zeros((self.frame_height, self.frame_width, 2 * frame_stack), dtype=np.uint8)
+        self._next_frame = 0
+        self._held_frame = np.zeros((self.frame_height, self.frame_width), dtype=np.uint8)
+
+    def observation_shape(self):
+        return self.frame_height, self.frame_width, self.frame_stack
+
+    def render_frame(self):
+        game = self._asteroids_game
+        scale_x, scale_y = self.scale_x, self.scale_y
+        self.surface.fill(0)
+
+        xs, ys = game.asteroids.x, game.asteroids.y
+        radius = max(1, round(game.asteroid_radius * scale_x))
+        for i in range(game.asteroids.size):
+            pygame.draw.circle(self.surface, self.ASTEROID, (int(xs[i] * scale_x), int(ys[i] * scale_y)), radius)
+
+        xs, ys = game.bullets.x, game.bullets.y
+        for i in range(game.bullets.size):
+            self.surface.set_at((int(xs[i] * scale_x), int(ys[i] * scale_y)), self.BULLET)
+
+        pygame.draw.polygon(self.surface, self.PLAYER,
+                            [(x * scale_x, y * scale_y) for x, y in game.get_player_points()])
+        return self.pixels
+
+    def push(self, frame):
+        index = self._next_frame
+        self._frames[:, :, index] = frame
+        self._frames[:, :, index + self.frame_stack] = frame
+        self._next_frame = (index + 1) % self.frame_stack
+
+    def stacked_frames(self):
+        # Oldest to newest along the last axis
+        return self._frames[:, :, self._next_frame:self._next_frame + self.frame_stack]
+
+    def hold_frame(self):
+        np.copyto(self._held_frame, self.render_frame())
+
+    def observe(self, max_with_held=False):
+        frame = self.render_frame()
+        if max_with_held:
+            frame = np.maximum(frame, self._held_frame, out=self._held_frame)
+        self.push(frame)
+        return self.stacked_frames()
+
+    def reset(self):
+        self._frames.fill(0)
+        self._next_frame = 0
+        return self.observe()
@@ -1,221 +1,251 @@
 import os
 import sys
+import time
 
 import tensorflow as tf
-from matplotlib import pyplot as plt
 from tf_agents.environments import tf_py_environment
 from tf_agents.networks import actor_distribution_network, value_network
 from tf_agents.agents.ppo import ppo_agent
-from tf_agents.policies import random_tf_policy
-from tf_agents.replay_buffers import tf_uniform_replay_buffer
-from tf_agents.trajectories import trajectory
 from tf_agents.utils import common
 
-from asteroids_env import AsteroidsEnvironment
+from asteroids_env import AsteroidsEnvironment, BatchedAsteroidsEnvironment
 from asteroids import AsteroidsGame
+from parallel_env import ProcessPoolEnvironment
+from background_eval import BackgroundEvaluator
+from drivers import create_collect_driver, create_return_evaluator
+from metrics import metrics
+from profiling import profiler
+from rollout_buffer import RolloutBuffer
 import numpy as np
 import pygame
 
 num_iterations = 10000
 
-initial_collect_steps = 15
-collect_steps_per_iteration = 15
-replay_buffer_capacity = 100000
+# Steps each training world runs per iteration; every iteration trains on the whole
+# num_parallel_environments x rollout_length rollout once and then discards it
+rollout_length = 128
 
 fc_layer_params = (100,)
 
-batch_size = 64
 learning_rate = 1e-3
 gamma = 0.99
 log_interval = 200
 
-n_step_update = 2
 num_epochs = 3
 
 num_eval_episodes = 10
 eval_interval = 1000
 
-# Create an instance using gym.make
-env = AsteroidsEnvironment(AsteroidsGame())
+# Skip the pygame window and all drawing while training
+headless = True
+
+# Worlds stepped together by the vectorized training environment
+num_parallel_environments = 8
+# Host the training worlds in worker processes instead of the in-process vectorized engine
+use_process_pool = False
+# Game ticks each chosen action is repeated for
+frame_skip = 1
+# Simulated seconds per game tick, None for one 1/60 s frame. Coarser ticks simulate a second in fewer ticks,
+# collisions are then checked in substeps
+dt = None
+
+# Evaluate policy snapshots in a separate process, on its own batch of num_eval_episodes worlds,
+# instead of stopping training for every evaluation
+background_evaluation = True
+
+# Episode, evaluation and training metrics are flushed here every metrics_flush_seconds by a background thread,
+# as any of 'csv', 'jsonl' and 'tensorboard'
+metrics_dir = os.path.join('saved_policy_ppo', 'metrics')
+metrics_formats = ('csv', 'tensorboard')
+metrics_flush_seconds = 10.0
+# 0 keeps the console quiet while training, 1 prints a metrics summary per flush, 2 also prints every record
+verbosity = 1
+
+# Time the game, env and training phases and print p50/p99 tables every profile_dump_seconds
+profile_phases = False
+profile_dump_seconds = 60
+
+
+def create_agent(train_env):
+    # Define the policy network
+    actor_net = actor_distribution_network.ActorDistributionNetwork(
+        train_env.observation_spec(),
+        train_env.action_spec(),
+        fc_layer_params=fc_layer_params)
+
+    value_net = value_network.ValueNetwork(
+        train_env.observation_spec(),
+        fc_layer_params=fc_layer_params)
+
+    # Define the PPO agent
+    optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=learning_rate)
+    # PPOAgent counts train steps in int64
+    train_step_counter = tf.Variable(0, dtype=tf.int64)
+    agent = ppo_agent.PPOAgent(
+        train_env.time_step_spec(),
+        train_env.action_spec(),
+        optimizer,
+        actor_net,
+        value_net,
+        num_epochs=10,  # Example value, tune as needed
+        train_step_counter=train_step_counter,
+        discount_factor=gamma,
+        entropy_regularization=0.2,  # Example value, tune as needed
+        importance_ratio_clipping=0.2,  # Example value, tune as needed
+        use_gae=True,
+        use_td_lambda_return=True)
+
+    # Initialize the agent
+    agent.initialize()
+    return agent
+
+
+def create_eval_policy(eval_env):
+    # Built again inside the background evaluator, which then loads the learner's weights into it
+    return create_agent(eval_env).policy
+
+
+def train_one_iteration(agent, rollout_buffer):
+    loss_info = agent.train(rollout_buffer.gather_all())
+    rollout_buffer.clear()
+    return loss_info
+
+
+def main():
+    if profile_phases:
+        profiler.enable()
+    metrics.start(metrics_dir, metrics_formats, metrics_flush_seconds, verbosity)
+
+    # Create an instance using gym.make
+    env = AsteroidsEnvironment(AsteroidsGame(headless=headless, dt=dt), frame_skip=frame_skip,
+                               metrics_prefix='eval_episode/')
+
+    env.reset()
+
+    print('Observation Spec:')
+    print(env.time_step_spec().observation)
+    print('Action Spec:')
+    print(env.action_spec())
+
+    time_step = env.reset()
+    print('Time step:')
+    print(time_step)
+
+    action = np.array(1, dtype=np.int32)
+
+    next_time_step = env.step(action)
+    print('Next time step:')
+    print(next_time_step)
+
+    if use_process_pool:
+        train_py_env = ProcessPoolEnvironment(num_parallel_environments,
+                                              core_options={'frame_skip': frame_skip, 'dt': dt})
+    else:
+        train_py_env = BatchedAsteroidsEnvironment(num_parallel_environments, frame_skip=frame_skip, dt=dt)
+    # The process pool holds worker processes and shared memory, both go away with it however training ends
+    try:
+        eval_py_env = env
+
+        train_env = tf_py_environment.TFPyEnvironment(train_py_env)
+        eval_env = tf_py_environment.TFPyEnvironment(eval_py_env)
+
+        agent = create_agent(train_env)
+
+        global_step = tf.compat.v1.train.get_or_create_global_step()
+
+        rollout_buffer = RolloutBuffer(agent.collect_data_spec, train_env.batch_size, rollout_length)
+        # One compiled run fills the whole rollout, one batched policy call per timestep for all the training worlds
+        collect_rollout = create_collect_driver(
+            train_env, agent.collect_policy, [rollout_buffer.graph_add_batch], rollout_length)
+        agent.train = common.function(agent.train)
+
+        evaluator = None
+        if background_evaluation:
+            evaluator = BackgroundEvaluator(create_eval_policy, num_eval_episodes, frame_skip=frame_skip, dt=dt)
+        else:
+            compute_avg_return = create_return_evaluator(eval_env, agent.policy, num_eval_episodes)
+
+        def report_returns(results):
+            for eval_step, avg_return in results:
+                metrics.record('eval/average_return', avg_return, eval_step)
+
+        def evaluate(eval_step):
+            if evaluator:
+                evaluator.submit(eval_step, agent.policy)
+            else:
+                with profiler.phase('train.compute_avg_return'):
+                    report_returns([(eval_step, compute_avg_return())])
+
+        evaluate(agent.train_step_counter.numpy())
+
+        policy_dir = 'saved_policy_ppo'
+
+        checkpoint_dir = os.path.join(policy_dir, 'checkpoint')
+        train_checkpointer = common.Checkpointer(
+            ckpt_dir=checkpoint_dir,
+            max_to_keep=4,
+            agent=agent,
+            policy=agent.policy,
+            collect_policy=agent.collect_policy,
+            global_step=global_step
+        )
+
+        if train_checkpointer.checkpoint_exists:
+            train_checkpointer.initialize_or_restore()
+            global_step = tf.compat.v1.train.get_global_step()
+            print(f"Checkpoint restored from {checkpoint_dir}")
+        else:
+            print(f"Checkpoint not found in {checkpoint_dir}")
+
+        collected_steps = 0
+        collect_seconds = 0.0
+        try:
+            for _ in range(num_iterations):
+                start = time.perf_counter()
+                with profiler.phase('train.collect_rollout'):
+                    collect_rollout()
+                collect_seconds += time.perf_counter() - start
+                collected_steps += train_env.batch_size * rollout_length
+
+                # Train the agent
+                with profiler.phase('train.agent_train'):
+                    train_loss = train_one_iteration(agent, rollout_buffer).loss
+
+                step = agent.train_step_counter.numpy()
+                metrics.set_step(step)
+                metrics.record('train/loss', float(train_loss))
+                profiler.dump_every(profile_dump_seconds)
+
+                if step % log_interval == 0:
+                    metrics.record('train/env_steps_per_sec', collected_steps / collect_seconds)
+                    collected_steps = 0
+                    collect_seconds = 0.0
+                    train_checkpointer.save(global_step)
+
+                if step % eval_interval == 0:
+                    evaluate(step)
+                if evaluator:
+                    report_returns(evaluator.poll())
+
+            if evaluator:
+                report_returns(evaluator.close())
+            metrics.close()
 
-env.reset()
-
-print('Observation Spec:')
-print(env.time_step_spec().observation)
-print('Action Spec:')
-print(env.action_spec())
-
-time_step = env.reset()
-print('Time step:')
-print(time_step)
-
-action = np.array(1, dtype=np.int32)
-
-next_time_step = env.step(action)
-print('Next time step:')
-print(next_time_step)
-
-train_py_env = env
-eval_py_env = env
-
-train_env = tf_py_environment.TFPyEnvironment(train_py_env)
-eval_env = tf_py_environment.TFPyEnvironment(eval_py_env)
-
-# Define the policy network
-actor_net = actor_distribution_network.ActorDistributionNetwork(
-    train_env.observation_spec(),
-    train_env.action_spec(),
-    fc_layer_params=fc_layer_params)
-
-value_net = value_network.ValueNetwork(
-    train_env.observation_spec(),
-    fc_layer_params=fc_layer_params)
-
-# Define the PPO agent
-optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=learning_rate)
-train_step_counter = tf.Variable(0)
-agent = ppo_agent.PPOAgent(
-    train_env.time_step_spec(),
-    train_env.action_spec(),
-    optimizer,
-    actor_net,
-    value_net,
-    num_epochs=10,  # Example value, tune as needed
-    train_step_counter=train_step_counter,
-    discount_factor=gamma,
-    entropy_regularization=0.2,  # Example value, tune as needed
-    importance_ratio_clipping=0.2,  # Example value, tune as needed
-    use_gae=True,
-    use_td_lambda_return=True)
-
-# Initialize the agent
-agent.initialize()
-
-avg_return_metric = tf.metrics.Mean(name='avg_return')
-
-global_step = tf.compat.v1.train.get_or_create_global_step()
-
-# Define training metrics
-def compute_avg_return(environment, policy, num_episodes=10):
-    total_return = 0.0
-    for _ in range(num_episodes):
-
-        time_step = environment.reset()
-        episode_return = 0.0
-
-        while not time_step.is_last():
-            action_step = policy.action(time_step)
-            time_step = environment.step(action_step.action)
-            episode_return += time_step.reward
-        total_return += episode_return
-
-    avg_return = total_return / num_episodes
-    return avg_return.numpy()[0]
-
-
-random_policy = random_tf_policy.RandomTFPolicy(train_env.time_step_spec(),
-                                                train_env.action_spec())
-
-compute_avg_return(eval_env, random_policy, num_eval_episodes)
-
-replay_buffer = tf_uniform_replay_buffer.TFUniformReplayBuffer(
-    data_spec=agent.collect_data_spec,
-    batch_size=train_env.batch_size,
-    max_length=replay_buffer_capacity)
-
-
-# Define training loop
-def train_one_iteration():
-    experience, unused_info = next(iterator)
-    return agent.train(experience)
-
-
-def collect_step(environment, policy):
-    time_step = environment.current_time_step()
-    action_step = policy.action(time_step)
-
-    next_time_step = environment.step(action_step.action)
-
-    # Create a trajectory with action distribution parameters included in policy_info
-    traj = trajectory.from_transition(
-        time_step,
-        action_step,
-        next_time_step
-    )
-
-    # Add trajectory to the replay buffer
-    replay_buffer.add_batch(traj)
-
-
-# Dataset generates trajectories with shape [BxTx...] where
-# T = n_step_update + 1.
-dataset = replay_buffer.as_dataset(
-    num_parallel_calls=3, sample_batch_size=batch_size,
-    num_steps=n_step_update + 1).prefetch(3)
-
-iterator = iter(dataset)
-
-avg_return = compute_avg_return(eval_env, agent.policy, num_eval_episodes)
-returns = [avg_return]
-
-policy_dir = 'saved_policy_ppo'
-
-# Define the collect policy (needed for collecting trajectories during training)
-collect_policy = agent.collect_policy
-
-checkpoint_dir = os.path.join(policy_dir, 'checkpoint')
-train_checkpointer = common.Checkpointer(
-    ckpt_dir=checkpoint_dir,
-    max_to_keep=4,
-    agent=agent,
-    policy=agent.policy,
-    collect_policy=agent.collect_policy,
-    replay_buffer=replay_buffer,
-    global_step=global_step
-)
-
-if train_checkpointer.checkpoint_exists:
-    train_checkpointer.initialize_or_restore()
-    global_step = tf.compat.v1.train.get_global_step()
-    print(f"Checkpoint restored from {checkpoint_dir}")
-else:
-    print(f"Checkpoint not found in {checkpoint_dir}")
-
-try:
-    for _ in range(num_iterations):
-        for _ in range(collect_steps_per_iteration):
-            collect_step(train_env, agent.collect_policy)
-
-        # Train the agent
-        train_loss = train_one_iteration().loss
-
-        avg_return = compute_avg_return(eval_env, agent.policy, num_eval_episodes)
-        avg_return_metric(avg_return)
-
-        step = agent.train_step_counter.numpy()
+            train_checkpointer.save(global_step)
+            print(f"Training ended, checkpoint saved to {checkpoint_dir}")
 
-        if step % log_interval == 0:
-            print('step = {0}: loss = {1}'.format(step, train_loss))
+        except KeyboardInterrupt:
+            print("Interrupted")
+            if evaluator:
+                evaluator.close(wait=False)
+            metrics.close()
             train_checkpointer.save(global_step)
             print(f"Checkpoint saved to {checkpoint_dir}")
+            pygame.quit()
+            sys.exit(0)
+    finally:
+        train_py_env.close()
+
 
-        if step % eval_interval == 0:
-            avg_return = compute_avg_return(eval_env, agent.policy, num_eval_episodes)
-            print('step = {0}: Average Return = {1:.2f}'.format(step, avg_return))
-            returns.append(avg_return)
-
-    steps = range(0, num_iterations + 1, eval_interval)
-    plt.plot(steps, returns)
-    plt.ylabel('Average Return')
-    plt.xlabel('Step')
-    plt.show()
-
-    train_checkpointer.save(global_step)
-    print(f"Training ended, checkpoint saved to {checkpoint_dir}")
-
-except KeyboardInterrupt:
-    print("Interrupted")
-    train_checkpointer.save(global_step)
-    print(f"Checkpoint saved to {checkpoint_dir}")
-    pygame.quit()
-    sys.exit(0)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import collections
+
+import numpy as np
+import tensorflow as tf
+
+from mmap_replay_buffer import MemmapReplayBuffer
+
+PrioritizedBufferInfo = collections.namedtuple('PrioritizedBufferInfo', ['ids', 'probabilities', 'weights'])
+
+
+class SumTree:
+    # Leaf priorities in the second half of nodes, every parent holds the sum of its two children
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._first_leaf = 1 << max(0, (capacity - 1).bit_length())
+        self.nodes = np.zeros(2 * self._first_leaf, dtype=np.float64)
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, indices):
+        return self.nodes[indices + self._first_leaf]
+
+    def update(self, indices, priorities):
+        # Whole batches at once: one vectorized pass per tree level instead of one walk per leaf.
+        # Parents shared by several leaves are just written more than once with the same sum
+        nodes = self.nodes
+        positions = np.asarray(indices) + self._first_leaf
+        nodes[positions] = priorities
+        while positions[0] > 1:
+            positions >>= 1
+            nodes[positions] = nodes[2 * positions] + nodes[2 * positions + 1]
+
+    def find(self, values):
+        # Index of the leaf each value falls into when the leaves are laid end to end
+        nodes = self.nodes
+        values = np.array(values, dtype=np.float64)
+        positions = np.ones(len(values), dtype=np.int64)
+        while positions[0] < self._first_leaf:
+            left = 2 * positions
+            left_sums = nodes[left]
+            # Rounding can leave a value just past the left sum, never step into an empty subtree
+            go_right = (values >= left_sums) & (nodes[left + 1] > 0)
+            values -= np.where(go_right, left_sums, 0.0)
+            positions = left + go_right
+        return positions - self._first_leaf
+
+
+class PrioritizedReplayBuffer(MemmapReplayBuffer):
+    # Samples num_steps windows in proportion to priority ** alpha, priorities are the last training loss
+    # of each window and new windows start at the highest priority seen so far
+    info_type = PrioritizedBufferInfo
+    info_dtypes = (tf.int64, tf.float32, tf.float32)
+
+    def __init__(self, data_spec, batch_size, max_length, directory, num_steps, alpha=0.6, beta=0.4,
+                 epsilon=1e-6, seed=None):
+        super().__init__(data_spec, batch_size, max_length, directory, seed=seed)
+        self.num_steps = num_steps
+        self.alpha = alpha
+        # Importance-sampling exponent, usually annealed towards 1 over training
+        self.beta = beta
+        self.epsilon = epsilon
+        self._tree = SumTree(max_length * batch_size)
+        self._max_priority = 1.0
+
+        # Priorities are not saved with the buffer, windows kept from an earlier run start at the maximum
+        stored = min(self._cursor, max_length)
+        starts = np.arange(self._cursor - stored, self._cursor - num_steps + 1)
+        if len(starts):
+            self._tree.update(self._leaves(starts), self._max_priority)
+
+    def _leaves(self, starts, environments=None):
+        rows = np.asarray(starts) % self.max_length
+        if environments is None:
+            return (rows[:, None] * self.batch_size + np.arange(self.batch_size)).ravel()
+        return rows * self.batch_size + environments
+
+    def num_windows(self):
+        return max(0, min(self._cursor, self.max_length) - self.num_steps + 1) * self.batch_size
+
+    def add_batch(self, items):
+        # The cursor moves on together with the tree, sample and update_priorities never see one without the other
+        with self._lock:
+            self._write_row(items)
+            cursor = self._cursor
+            # The overwritten row no longer starts a full window, the one ending at the new row now does
+            starts = [cursor - 1, cursor - self.num_steps] if cursor >= self.num_steps else [cursor - 1]
+            priorities = np.repeat([0.0, self._max_priority][:len(starts)], self.batch_size)
+            self._tree.update(self._leaves(starts), priorities)
+
+    def sample(self, sample_batch_size, num_steps):
+        if num_steps != self.num_steps:
+            raise ValueError(f"This buffer samples windows of {self.num_steps} steps, not {num_steps}")
+        with self._lock:
+            total = self._tree.total()
+            if total <= 0:
+                raise ValueError(f"Need {num_steps} stored steps to sample from")
+            # Stratified: one draw from each of sample_batch_size equal slices of the total priority
+            strata = np.arange(sample_batch_size) + self._random.random(sample_batch_size)
+            values = strata * (total / sample_batch_size)
+            leaves = self._tree.find(values)
+            probabilities = self._tree.get(leaves) / total
+            cursor = self._cursor
+            num_windows = self.num_windows()
+
+            # Gathered under the lock too, so add_batch cannot overwrite a window after its leaf was chosen
+            rows, environments = np.divmod(leaves, self.batch_size)
+            window_rows = (rows[:, None] + np.arange(num_steps)) % self.max_length
+            items = [column[window_rows, environments[:, None]] for column in self._columns]
+
+        # Ids are step counts rather than rows, so update_priorities can tell a window was overwritten since
+        starts = cursor - 1 - (cursor - 1 - rows) % self.max_length
+        ids = starts * self.batch_size + environments
+        weights = (num_windows * probabilities) ** -self.beta
+        weights /= weights.max()
+        return items, self.info_type(ids, probabilities.astype(np.float32), weights.astype(np.float32))
+
+    def update_priorities(self, ids, losses):
+        starts, environments = np.divmod(np.asarray(ids), self.batch_size)
+        losses = np.abs(np.asarray(losses, dtype=np.float64))
+        with self._lock:
+            cursor = self._cursor
+            valid = (starts >= cursor - min(cursor, self.max_length)) & (starts <= cursor - self.num_steps)
+            if not valid.any():
+                return
+            priorities = (losses[valid] + self.epsilon) ** self.alpha
+            self._tree.update(self._leaves(starts[valid], environments[valid]), priorities)
+            self._max_priority = max(self._max_priority, priorities.max())
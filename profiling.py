@@ -0,0 +1,106 @@
+import json
+import math
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+class PhaseProfiler:
+    def __init__(self, enabled=False, window=4096):
+        self.enabled = enabled
+        # Percentiles come from the latest window durations of each phase
+        self.window = window
+        self._phases = {}
+        self._last_dump = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self._last_dump = time.perf_counter()
+
+    def reset(self):
+        self._phases.clear()
+
+    def record(self, name, seconds):
+        phase = self._phases.get(name)
+        if phase is None:
+            phase = self._phases[name] = {'calls': 0, 'total': 0.0, 'samples': [0.0] * self.window, 'buckets': {}}
+        phase['samples'][phase['calls'] % self.window] = seconds
+        phase['calls'] += 1
+        phase['total'] += seconds
+        # Power-of-two microsecond buckets, kept for every call
+        bucket = max(0, math.frexp(seconds * 1e6)[1])
+        phase['buckets'][bucket] = phase['buckets'].get(bucket, 0) + 1
+
+    def timed(self, name, function):
+        record = self.record
+        perf_counter = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, perf_counter() - start)
+
+        return wrapper
+
+    def instrument(self, obj, prefix, *method_names):
+        # Shadows the methods on this instance only; nothing is wrapped while profiling is off
+        if not self.enabled:
+            return
+        for method_name in method_names:
+            setattr(obj, method_name, self.timed(prefix + method_name, getattr(obj, method_name)))
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        snapshot = {}
+        for name, phase in self._phases.items():
+            samples = sorted(phase['samples'][:min(phase['calls'], self.window)])
+            snapshot[name] = {
+                'calls': phase['calls'],
+                'total_seconds': phase['total'],
+                'mean_ms': phase['total'] / phase['calls'] * 1e3,
+                'p50_ms': samples[int(0.50 * (len(samples) - 1))] * 1e3,
+                'p99_ms': samples[int(0.99 * (len(samples) - 1))] * 1e3,
+                'histogram_us': {f"<{2 ** bucket}": count for bucket, count in sorted(phase['buckets'].items())},
+            }
+        return snapshot
+
+    def dump(self, path=None, file=sys.stdout):
+        snapshot = self.snapshot()
+        if path:
+            with open(path, 'w') as f:
+                json.dump(snapshot, f, indent=2)
+            return snapshot
+
+        total = sum(phase['total_seconds'] for phase in snapshot.values()) or 1.0
+        print(f"{'phase':<28} {'calls':>9} {'total s':>9} {'share':>6} {'p50 ms':>9} {'p99 ms':>9}", file=file)
+        for name, phase in sorted(snapshot.items(), key=lambda item: -item[1]['total_seconds']):
+            print(f"{name:<28} {phase['calls']:>9} {phase['total_seconds']:>9.3f} "
+                  f"{phase['total_seconds'] / total:>6.1%} {phase['p50_ms']:>9.4f} {phase['p99_ms']:>9.4f}",
+                  file=file)
+            peak = max(phase['histogram_us'].values())
+            for bucket, count in phase['histogram_us'].items():
+                print(f"    {bucket:>10}us {'#' * max(1, round(40 * count / peak)):<40} {count}", file=file)
+        return snapshot
+
+    def dump_every(self, seconds, path=None):
+        # For calling on every loop iteration, dumps at most once per seconds
+        if self.enabled and time.perf_counter() - self._last_dump >= seconds:
+            self._last_dump = time.perf_counter()
+            self.dump(path)
+
+
+# Shared by the game, the environments and the training scripts; ASTEROIDS_PROFILE=1 turns it on
+profiler = PhaseProfiler(enabled=os.environ.get('ASTEROIDS_PROFILE') == '1')
@@ -0,0 +1,130 @@
+import pygame
+
+from headings import rotate_points
+from profiling import profiler
+
+
+class GameRenderer:
+    # Draws a game into its window from sprites rasterized once. Each frame only erases what the last frame
+    # drew and sends just those rectangles and the new ones to the display
+    ANGLE_STEP = 5
+    BACKGROUND = (0, 0, 0)
+    erase_rect_limit = 8
+
+    def __init__(self, game):
+        self._game = game
+        self.screen = game.screen
+        self.font = pygame.font.Font(None, 36)
+        self.overlay_font = pygame.font.Font(None, 24)
+        self._score = None
+        self._score_surface = None
+        self._overlay = []
+        self._overlay_surfaces = []
+
+        self.asteroid_sprite = self._circle_sprite(game.asteroid_radius, game.RED)
+        self.bullet_sprite = self._circle_sprite(5, game.WHITE)
+        # The ship turns in ANGLE_STEP degree steps, the outlines of a ship in the middle of the screen are
+        # rasterized up front
+        self.ship_sprites = {}
+        for angle in range(0, 360, self.ANGLE_STEP):
+            points = [(game.WIDTH // 2 + x, game.HEIGHT // 2 + y) for x, y in rotate_points(game.player_shape, angle)]
+            outline, _ = self._ship_outline(points)
+            self.ship_sprites[outline] = self._ship_sprite(outline)
+
+        self._drawn = []
+        self._erased = []
+        self._full_update = True
+
+        profiler.instrument(self, 'render.', 'draw_ship', 'draw_bullets', 'draw_asteroids', 'draw_score', 'draw_overlay',
+                            'flip')
+
+    def _sprite_surface(self, width, height):
+        surface = pygame.Surface((width, height))
+        surface.fill(self.BACKGROUND)
+        surface.set_colorkey(self.BACKGROUND)
+        return surface
+
+    def _circle_sprite(self, radius, color):
+        surface = self._sprite_surface(2 * radius, 2 * radius)
+        pygame.draw.circle(surface, color, (radius, radius), radius)
+        return surface.convert(), radius
+
+    def _ship_outline(self, points):
+        # pygame.draw.polygon truncates the outline to whole pixels. Float noise and fractional positions move
+        # single vertices a pixel against the others, so the ship is keyed by its truncated outline relative to
+        # the top left corner, and drawn there
+        vertices = [(int(x), int(y)) for x, y in points]
+        left = min(x for x, _ in vertices)
+        top = min(y for _, y in vertices)
+        return tuple((x - left, y - top) for x, y in vertices), (left, top)
+
+    def _ship_sprite(self, outline):
+        surface = self._sprite_surface(max(x for x, _ in outline) + 1, max(y for _, y in outline) + 1)
+        pygame.draw.polygon(surface, self._game.WHITE, outline)
+        return surface.convert()
+
+    def draw_ship(self):
+        # A new outline gets its sprite on first sight, so the ship looks exactly like the polygon it stands for
+        outline, position = self._ship_outline(self._game.get_player_points())
+        sprite = self.ship_sprites.get(outline)
+        if sprite is None:
+            sprite = self.ship_sprites[outline] = self._ship_sprite(outline)
+        self._drawn.append(self.screen.blit(sprite, position))
+
+    def _draw_circles(self, pool, sprite):
+        sprite, radius = sprite
+        xs, ys = pool.x, pool.y
+        self._drawn += self.screen.blits([(sprite, (int(xs[i]) - radius, int(ys[i]) - radius))
+                                          for i in range(pool.size)])
+
+    def draw_bullets(self):
+        self._draw_circles(self._game.bullets, self.bullet_sprite)
+
+    def draw_asteroids(self):
+        self._draw_circles(self._game.asteroids, self.asteroid_sprite)
+
+    def draw_score(self):
+        # Text is only rendered again when the score changes
+        score = self._game.player_score
+        if score != self._score:
+            self._score = score
+            self._score_surface = self.font.render("Score: " + str(score), True, self._game.WHITE)
+        self._drawn.append(self.screen.blit(self._score_surface, (10, 10)))
+
+    def set_overlay(self, lines):
+        # Text lines in the top right corner, e.g. timings; rendered again only when they change
+        if lines != self._overlay:
+            self._overlay = list(lines)
+            self._overlay_surfaces = [self.overlay_font.render(line, True, self._game.WHITE) for line in lines]
+
+    def draw_overlay(self):
+        for index, surface in enumerate(self._overlay_surfaces):
+            position = (self._game.WIDTH - surface.get_width() - 10, 10 + 20 * index)
+            self._drawn.append(self.screen.blit(surface, position))
+
+    def draw(self):
+        # Erasing last frame's rectangles is enough, everything else on the screen is still background.
+        # A small fill costs about as much as a tenth of a full one, so busy frames clear everything instead
+        self._erased = self._drawn
+        if len(self._erased) > self.erase_rect_limit:
+            self.screen.fill(self.BACKGROUND)
+        else:
+            for rect in self._erased:
+                self.screen.fill(self.BACKGROUND, rect)
+        self._drawn = []
+        self.draw_ship()
+        self.draw_bullets()
+        self.draw_asteroids()
+        self.draw_score()
+        self.draw_overlay()
+
+    def flip(self):
+        if self._full_update:
+            pygame.display.flip()
+            self._full_update = False
+        else:
+            pygame.display.update(self._erased + self._drawn)
+
+    def invalidate(self):
+        # The next flip sends the whole screen, e.g. once the window was covered by something else
+        self._full_update = True
@@ -0,0 +1,36 @@
+import numpy as np
+import tensorflow as tf
+
+
+class RolloutBuffer:
+    # Preallocated [num_envs, num_steps] arrays for one on-policy rollout, filled a timestep at a time,
+    # handed to the agent whole and then cleared
+    def __init__(self, data_spec, num_envs, num_steps):
+        self.data_spec = data_spec
+        self.num_envs = num_envs
+        self.num_steps = num_steps
+        self._arrays = [np.zeros((num_envs, num_steps) + tuple(spec.shape.as_list()), dtype=spec.dtype.as_numpy_dtype)
+                        for spec in tf.nest.flatten(data_spec)]
+        self._step = 0
+
+    def __len__(self):
+        return self._step
+
+    def add_batch(self, items):
+        if self._step == self.num_steps:
+            raise ValueError(f"The rollout is full at {self.num_steps} steps, clear() it after training")
+        for array, value in zip(self._arrays, tf.nest.flatten(items)):
+            array[:, self._step] = value
+        self._step += 1
+
+    def graph_add_batch(self, items):
+        # add_batch as an observer for compiled drivers, where items are symbolic tensors
+        tf.numpy_function(lambda *values: self.add_batch(tf.nest.pack_sequence_as(self.data_spec, values)),
+                          tf.nest.flatten(items), [])
+
+    def gather_all(self):
+        return tf.nest.pack_sequence_as(
+            self.data_spec, [tf.convert_to_tensor(array[:, :self._step]) for array in self._arrays])
+
+    def clear(self):
+        self._step = 0
@@ -0,0 +1,33 @@
+import collections
+import math
+
+TickTiming = collections.namedtuple('TickTiming', ['dt', 'frames_per_tick', 'substeps', 'player_step', 'turn_step',
+                                                   'bullet_step', 'asteroid_step'])
+
+
+def tick_timing(game, dt=None):
+    # The per-tick steps of a game with FPS, turn_speed, player_speed, bullet_speed, asteroid_speed and
+    # collision_step attributes, shared by AsteroidsGame and BatchedAsteroidsGame so both simulate the same tick.
+    # dt is simulated seconds per tick, None for one frame at FPS
+    if dt is not None and dt <= 0:
+        raise ValueError(f"dt has to be positive, got {dt}")
+    frames = (1 / game.FPS if dt is None else dt) * game.FPS
+    # The ship turns in whole degrees, a tick that would have to turn it by a fraction of one is refused
+    # rather than quietly turning it faster or slower
+    turn = game.turn_speed * frames
+    if round(turn) < 1 or not math.isclose(turn, round(turn)):
+        raise ValueError(f"dt has to be a multiple of 1/{game.FPS * game.turn_speed} s, so every tick turns "
+                         f"the ship whole degrees; dt={dt} would turn it {turn:g} degrees")
+    # Whole frames stay integers, so the default tick moves everything exactly as many pixels as before
+    frames_per_tick = round(frames) if math.isclose(frames, round(frames)) else frames
+    # Bullets and asteroids move once per substep, so a coarse dt does not let bullets pass through asteroids
+    substeps = max(1, math.ceil((game.bullet_speed + game.asteroid_speed) * frames_per_tick / game.collision_step))
+    return TickTiming(
+        dt=1 / game.FPS if dt is None else dt,
+        frames_per_tick=frames_per_tick,
+        substeps=substeps,
+        player_step=game.player_speed * frames_per_tick,
+        turn_step=round(turn),
+        bullet_step=game.bullet_speed * frames_per_tick / substeps,
+        asteroid_step=game.asteroid_speed * frames_per_tick / substeps,
+    )